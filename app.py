@@ -2,9 +2,14 @@
 import dash
 import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
+from dash import dcc, html
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
+import atexit
 import os
+import shutil
 import sys
+import uuid
 
 # Set the working directory to the directory of this file
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -12,15 +17,17 @@ os.chdir(current_dir)
 sys.path.append(current_dir)
 
 # Import the HighwayTrafficSimulation class from our local file
-from app.utils.highway_traffic_and_car_sim import (
-    HighwayTrafficSimulation,
-    HIGHWAY_LENGTH,
-)
+from app.utils.highway_traffic_and_car_sim import HighwayTrafficSimulation
 from app.main import layout
+from app.utils.simulation_worker import SimulationWorker
+from app.utils.session_manager import FileSessionStore, SessionManager, is_session_id
+from app.utils.trajectory import Trajectory
 from app.utils.utils import (
     create_figure,
     create_placeholder_figure,
     create_figure_statisticts,
+    car_trace_patch,
+    statistics_extension,
     collapse_button,
 )
 
@@ -28,29 +35,260 @@ from app.utils.utils import (
 # Initialize the Dash app
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.SANDSTONE])
 
+
+def serve_layout():
+    # Every page load gets its own simulation session
+    return html.Div([dcc.Store(id="session-id", data=uuid.uuid4().hex), layout])
+
+
 # Define the layout of the app
-app.layout = layout
+app.layout = serve_layout
+
+
+# In[3]: Initialize the traffic simulation sessions
+# A recorded trajectory stops growing at this size
+TRAJECTORY_MAX_BYTES = 256 * 2**20
+
+
+def session_dir(session_id):
+    """Returns the directory of a session's statistics, checkpoints and trajectory."""
+    return f"../../results/sessions/{session_id}"
+
+
+def plain_name(name):
+    """Returns `name` stripped, raising ValueError unless it is a plain file name.
+
+    Names come from the browser, so only plain names are accepted and a
+    browser can neither write nor read files outside its session.
+    """
+    name = (name or "").strip()
+    if not name or ".." in name or "/" in name or "\\" in name:
+        raise ValueError(f"{name!r} is not a plain file name")
+    return name
+
+
+def session_checkpoint(session_id, name):
+    """Returns the path of checkpoint `name` in the session's own directory."""
+    name = plain_name(name)
+    if not name.endswith(".npz"):
+        name += ".npz"
+    return os.path.join(session_dir(session_id), "checkpoints", name)
+
+
+def session_trajectory_path(session_id, name=None):
+    """Returns the directory of trajectory `name` in the session's own
+    directory, "trajectory" when no name is given."""
+    return os.path.join(
+        session_dir(session_id), "trajectories", plain_name(name or "trajectory")
+    )
+
+
+def create_session(session_id):
+    # Each session steps its own simulation with its own random stream and
+    # saves a checkpoint with its other checkpoints every 1000 steps. It records
+    # its trajectory only while "Record this run" is on
+    results_dir = session_dir(session_id)
+    traffic_sim = HighwayTrafficSimulation(
+        results_dir=results_dir,
+        seed=uuid.UUID(session_id).int % 2**32,
+        autosave_path=session_checkpoint(session_id, "autosave.npz"),
+        trajectory_max_bytes=TRAJECTORY_MAX_BYTES,
+    )
+    return SimulationWorker(traffic_sim)
+
+
+def remove_session_files(session_id):
+    # An expired session is never restored, so its files can go too
+    shutil.rmtree(session_dir(session_id), ignore_errors=True)
+
+
+# Sessions evicted from memory are saved here for a day and survive restarts.
+# Sessions run on threads of this process, so serve the app from a single
+# process with several threads, see SessionManager
+sessions = SessionManager(
+    create_session,
+    store=FileSessionStore(
+        os.environ.get(
+            "PENGUIN_TRAFFIC_SESSION_DIR", os.path.join(current_dir, "sessions")
+        ),
+        ttl=24 * 60 * 60,
+    ),
+    on_expire=remove_session_files,
+)
+atexit.register(sessions.close)  # Save the sessions and flush their statistics
+
+
+def session_worker(session_id):
+    """Returns the worker of a session, ignoring requests with a forged id."""
+    if not is_session_id(session_id):
+        raise PreventUpdate
+    return sessions.get(session_id)
+
+
+# In[4]: Define the callbacks
+def configure_worker(
+    worker,
+    simulation_type,
+    speed_slider_value,
+    lane_slider_value,
+    interval_value,
+    highway_length=None,
+):
+    """Passes the current controls on to the background simulation worker."""
+    worker.configure(
+        simulation_type=simulation_type,
+        spawn_rate=speed_slider_value,
+        lane_value=lane_slider_value,
+        # milliseconds between simulation steps, 0 steps as fast as possible
+        step_interval=(interval_value or 0) / 1000,
+        # an empty or invalid length keeps the current road
+        highway_length=highway_length if highway_length and highway_length > 0 else None,
+    )
 
 
-# In[3]: Define the callbacks
 @app.callback(
     Output("interval-component", "disabled"),
     Input("start-button", "n_clicks"),
     Input("stop-button", "n_clicks"),
+    Input("reset-button", "n_clicks"),
+    State("simulation-type", "value"),
+    State("speed-slider", "value"),
+    State("lane-slider", "value"),
+    State("interval-input", "value"),
+    State("highway-length", "value"),
+    State("session-id", "data"),
     prevent_initial_call=True,
 )
-def control_simulation(start_clicks, stop_clicks):
+def control_simulation(
+    start_clicks,
+    stop_clicks,
+    reset_clicks,
+    simulation_type,
+    speed_slider_value,
+    lane_slider_value,
+    interval_value,
+    highway_length,
+    session_id,
+):
     ctx = dash.callback_context
     if not ctx.triggered:
         return True  # Disabled by default
 
+    worker = session_worker(session_id)
     button_id = ctx.triggered[0]["prop_id"].split(".")[0]
     if button_id == "start-button":
+        configure_worker(
+            worker,
+            simulation_type,
+            speed_slider_value,
+            lane_slider_value,
+            interval_value,
+            highway_length,
+        )
+        worker.start()  # Step the model in the background
         return False  # Enable interval when Start is clicked
+    elif button_id == "reset-button":
+        worker.reset()  # Flush the statistics and clear the highway
+        return True
     else:
+        worker.pause()  # Write buffered statistics on Stop
         return True  # Disable interval when Stop is clicked
 
 
+@app.callback(
+    Output("checkpoint-status", "children"),
+    Input("save-checkpoint-button", "n_clicks"),
+    Input("load-checkpoint-button", "n_clicks"),
+    State("checkpoint-path", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def manage_checkpoint(save_clicks, load_clicks, name, session_id):
+    if not name:
+        return "Enter a checkpoint name first."
+
+    worker = session_worker(session_id)
+    button_id = dash.callback_context.triggered[0]["prop_id"].split(".")[0]
+    try:
+        path = session_checkpoint(session_id, name)
+        if button_id == "save-checkpoint-button":
+            worker.save_checkpoint(path)
+            return f"Saved step {worker.traffic_sim.time_elapsed} as {os.path.basename(path)}."
+        worker.load_checkpoint(path)  # Pauses, press Start to continue
+        return f"Loaded step {worker.traffic_sim.time_elapsed} from {os.path.basename(path)}."
+    except (OSError, ValueError, KeyError) as error:
+        return f"Checkpoint failed: {error}"
+
+
+@app.callback(
+    Output("record-switch", "label"),
+    Input("record-switch", "value"),
+    State("trajectory-name", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def toggle_recording(record, name, session_id):
+    # Switching recording on starts a new trajectory of this session
+    worker = session_worker(session_id)
+    if not record:
+        worker.set_recording(None)
+        return "Record this run"
+    try:
+        path = session_trajectory_path(session_id, name)
+    except ValueError as error:
+        worker.set_recording(None)
+        return f"Not recording: {error}"
+    worker.set_recording(path)
+    return f"Recording {os.path.basename(path)}, up to {TRAJECTORY_MAX_BYTES // 2**20} MB"
+
+
+def session_trajectory(name, session_id):
+    """Opens trajectory `name` of the session, see session_trajectory_path.
+
+    The trajectory is opened again on every call rather than cached, so no
+    map outlives the request that reads it.
+    """
+    path = session_trajectory_path(session_id, name)
+    worker = session_worker(session_id)
+    if worker.traffic_sim.trajectory_path == path:
+        worker.pause()  # Write the ticks recorded so far
+    return Trajectory(path)
+
+
+@app.callback(
+    Output("playback-slider", "max"),
+    Output("playback-slider", "value"),
+    Output("playback-interval", "disabled"),
+    Input("playback-switch", "value"),
+    State("trajectory-name", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def toggle_playback(playback, name, session_id):
+    if not playback:
+        return dash.no_update, dash.no_update, True
+    try:
+        trajectory = session_trajectory(name, session_id)
+    except (OSError, ValueError):
+        return 0, 0, True
+    # Start from the most recent tick, scrubbing moves back from there
+    return max(len(trajectory) - 1, 0), max(len(trajectory) - 1, 0), False
+
+
+@app.callback(
+    Output("playback-slider", "value", allow_duplicate=True),
+    Input("playback-interval", "n_intervals"),
+    State("playback-slider", "value"),
+    State("playback-slider", "max"),
+    State("playback-speed", "value"),
+    prevent_initial_call=True,
+)
+def advance_playback(n, tick, last_tick, ticks_per_frame):
+    if not ticks_per_frame:
+        return dash.no_update
+    return min(max((tick or 0) + ticks_per_frame, 0), last_tick)
+
+
 @app.callback(
     Output("collapse", "is_open"),
     Input("collapse-button", "n_clicks"),
@@ -61,48 +299,197 @@ def toggle_collapse(n, is_open):
     collapse_button(n, is_open)
 
 
-# Initialize the traffic simulation
-traffic_sim = HighwayTrafficSimulation()
+@app.callback(
+    Output("viewport", "data"),
+    Input("highway-graph", "relayoutData"),
+    prevent_initial_call=True,
+)
+def update_viewport(relayout):
+    # Zooming or panning the road redraws only the cars in view
+    relayout = relayout or {}
+    if "xaxis.range[0]" in relayout:
+        return [relayout["xaxis.range[0]"], relayout["xaxis.range[1]"]]
+    if "xaxis.range" in relayout:
+        return relayout["xaxis.range"]
+    if relayout.get("xaxis.autorange"):
+        return [0, None]  # Zooming out shows the whole road
+    return dash.no_update
 
 
 @app.callback(
     Output("highway-graph", "figure"),
     Output("highway-graph-statistics", "figure"),
+    Output("highway-graph-statistics", "extendData"),
+    Output("render-state", "data"),
     Input("interval-component", "n_intervals"),
     Input("simulation-type", "value"),
+    Input("playback-slider", "value"),
+    Input("viewport", "data"),
     State("start-button", "n_clicks"),
     State("speed-slider", "value"),
     State("lane-slider", "value"),
+    State("interval-input", "value"),
+    State("streaming-switch", "value"),
+    State("render-state", "data"),
+    State("session-id", "data"),
+    State("playback-switch", "value"),
+    State("trajectory-name", "value"),
+    State("highway-length", "value"),
 )
 def update_traffic(
-    n, simulation_type, start_button, speed_slider_value, lane_slider_value
+    n,
+    simulation_type,
+    playback_tick,
+    viewport,
+    start_button,
+    speed_slider_value,
+    lane_slider_value,
+    interval_value,
+    streaming,
+    render_state,
+    session_id,
+    playback,
+    trajectory_name,
+    highway_length,
 ):
 
+    if playback:
+        return replay_traffic(
+            playback_tick, trajectory_name, session_id, streaming, render_state, viewport
+        )
+
     if start_button == 0:
         return (
             create_placeholder_figure("/assets/mana5280-DAQOskiNFtg-unsplash.jpg"),
             create_placeholder_figure(
                 "/assets/rod-long-ZFA5c0loQE8-unsplash.jpg"
             ),
+            dash.no_update,
+            None,
         )
 
-    # Make sure function executes only when necessary
-    if simulation_type == "simple":
-        traffic_sim.update_simple(speed_slider_value, lane_slider_value)
+    # The worker advances the model, here we only pick up its latest frame
+    worker = session_worker(session_id)
+    configure_worker(
+        worker,
+        simulation_type,
+        speed_slider_value,
+        lane_slider_value,
+        interval_value,
+        highway_length,
+    )
+    frame = worker.latest()
+    profiler = worker.traffic_sim.profiler
 
-    elif simulation_type == "individualistic":
-        traffic_sim.update_individualistic(speed_slider_value, lane_slider_value)
+    stats = frame.statistics
+    last_time = int(stats.last("time_elapsed")) if len(stats) else None
+    new_render_state = {
+        "lanes": lane_slider_value,
+        "time": last_time,
+        "road": [frame.highway_length, viewport],
+        # a reset or a loaded checkpoint starts a new run, drawn from scratch
+        "generation": frame.generation,
+    }
 
-    elif simulation_type == "penguin":
-        traffic_sim.update_penguin(speed_slider_value, lane_slider_value)
+    # Send only the new data once the browser holds a matching full figure
+    if (
+        streaming
+        and render_state is not None
+        and not render_state.get("playback")
+        and render_state["lanes"] == lane_slider_value
+        and render_state.get("road") == new_render_state["road"]
+        and render_state.get("generation") == frame.generation
+        and render_state["time"] is not None
+        and last_time is not None
+        and last_time >= render_state["time"]
+    ):
+        with profiler.phase("figure"):
+            car_figure = car_trace_patch(lane_slider_value, frame, viewport)
+        with profiler.phase("statistics_figure"):
+            extension = statistics_extension(frame, render_state["time"])
+        return car_figure, dash.no_update, extension, new_render_state
 
     # Handle other simulation types or return a default figure
+    with profiler.phase("figure"):
+        car_figure = create_figure(lane_slider_value, frame, viewport)
+    with profiler.phase("statistics_figure"):
+        statistics_figure = create_figure_statisticts(frame)
+    return car_figure, statistics_figure, dash.no_update, new_render_state
+
+
+@app.callback(
+    Output("perf-panel", "children"),
+    Input("interval-component", "n_intervals"),
+    Input("perf-switch", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def update_perf_panel(n, show, session_id):
+    profiler = session_worker(session_id).traffic_sim.profiler
+    profiler.enabled = bool(show)  # Timing costs nothing while hidden
+    if not show:
+        return None
+
+    summary = profiler.summary()
+    if not summary:
+        return html.Div("No ticks timed yet, press Start.")
+    columns = ["count", "mean_ms", "p50_ms", "p90_ms", "p99_ms"]
+    return dbc.Table(
+        [
+            html.Thead(html.Tr([html.Th("Phase")] + [html.Th(c) for c in columns])),
+            html.Tbody(
+                [
+                    html.Tr(
+                        [html.Td(name)]
+                        + [html.Td(f"{row[c]:.3f}" if c != "count" else row[c]) for c in columns]
+                    )
+                    for name, row in summary.items()
+                ]
+            ),
+        ],
+        size="sm",
+        striped=True,
+    )
+
+
+def replay_traffic(tick, trajectory_name, session_id, streaming, render_state, viewport):
+    """Draws a recorded tick without stepping the simulation."""
+    try:
+        trajectory = session_trajectory(trajectory_name, session_id)
+    except (OSError, ValueError):
+        return dash.no_update, dash.no_update, dash.no_update, render_state
+    if len(trajectory) == 0:
+        return dash.no_update, dash.no_update, dash.no_update, render_state
+
+    tick = min(tick or 0, len(trajectory) - 1)
+    frame = trajectory.frame(tick)
+    lanes = int(trajectory.ticks[tick]["lane_value"])
+    new_render_state = {
+        "lanes": lanes,
+        "time": frame.time_elapsed,
+        "road": [frame.highway_length, viewport],
+        "playback": True,
+    }
+
+    # Seeking can go backwards, so the statistics are redrawn rather than extended
+    if (
+        streaming
+        and render_state is not None
+        and render_state.get("playback")
+        and render_state["lanes"] == lanes
+        and render_state.get("road") == new_render_state["road"]
+    ):
+        car_figure = car_trace_patch(lanes, frame, viewport)
+    else:
+        car_figure = create_figure(lanes, frame, viewport)
     return (
-        create_figure(lane_slider_value, traffic_sim), 
-        create_figure_statisticts(traffic_sim)
+        car_figure,
+        create_figure_statisticts(frame),
+        dash.no_update,
+        new_render_state,
     )
 
 
-# In[4]: Run the app
+# In[5]: Run the app
 if __name__ == "__main__":
     app.run_server(debug=True, port=8050)
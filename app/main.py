@@ -4,6 +4,7 @@ import dash_bootstrap_components as dbc
 
 # In[2]: Initalize parameters
 FRAME_RATE = 1000  # Update every second
+PLAYBACK_FRAME_RATE = 100  # Playback redraws ten times a second
 
 # In[3]: app layout
 layout = html.Div(
@@ -133,6 +134,62 @@ layout = html.Div(
                                                                                 "width": "50%"
                                                                             },
                                                                         ),
+                                                                        dbc.Switch(
+                                                                            id="streaming-switch",
+                                                                            label="Stream updates",
+                                                                            value=True,
+                                                                            style={
+                                                                                "margin-top": "10px"
+                                                                            },
+                                                                        ),
+                                                                        dbc.Switch(
+                                                                            id="perf-switch",
+                                                                            label="Show performance",
+                                                                            value=False,
+                                                                        ),
+                                                                        html.Div(
+                                                                            "Checkpoint:",
+                                                                            style={
+                                                                                "margin-top": "10px",
+                                                                                "margin-bottom": "5px",
+                                                                            },
+                                                                        ),
+                                                                        dcc.Input(
+                                                                            id="checkpoint-path",
+                                                                            type="text",
+                                                                            placeholder="checkpoint name",
+                                                                            style={
+                                                                                "width": "50%"
+                                                                            },
+                                                                        ),
+                                                                        html.Div(
+                                                                            [
+                                                                                dbc.Button(
+                                                                                    "Save",
+                                                                                    id="save-checkpoint-button",
+                                                                                    n_clicks=0,
+                                                                                    color="secondary",
+                                                                                    size="sm",
+                                                                                    className="me-2",
+                                                                                ),
+                                                                                dbc.Button(
+                                                                                    "Load",
+                                                                                    id="load-checkpoint-button",
+                                                                                    n_clicks=0,
+                                                                                    color="secondary",
+                                                                                    size="sm",
+                                                                                ),
+                                                                            ],
+                                                                            style={
+                                                                                "margin-top": "5px"
+                                                                            },
+                                                                        ),
+                                                                        html.Div(
+                                                                            id="checkpoint-status",
+                                                                            style={
+                                                                                "margin-top": "5px"
+                                                                            },
+                                                                        ),
                                                                     ]
                                                                 )
                                                             ),
@@ -172,6 +229,18 @@ layout = html.Div(
                                                                     "label": "Penguin",
                                                                     "value": "penguin",
                                                                 },
+                                                                {
+                                                                    "label": "Lattice",
+                                                                    "value": "lattice",
+                                                                },
+                                                                {
+                                                                    "label": "Lattice penguin",
+                                                                    "value": "lattice_penguin",
+                                                                },
+                                                                {
+                                                                    "label": "Lattice with lane changes",
+                                                                    "value": "lattice_lanes",
+                                                                },
                                                             ],
                                                             value="simple",  # Ensure valid default
                                                             style={"width": "50%"},
@@ -235,16 +304,92 @@ layout = html.Div(
                 "border-radius": "5px",
             },
         ),
+        html.Div(
+            [
+                html.Div("Playback:", style={"margin-bottom": "5px"}),
+                dbc.Row(
+                    [
+                        dbc.Col(
+                            # Recording is off unless asked for, it grows
+                            # by several MB a second on a busy road
+                            dbc.Switch(
+                                id="record-switch",
+                                label="Record this run",
+                                value=False,
+                            ),
+                            width=3,
+                        ),
+                        dbc.Col(
+                            dbc.Switch(
+                                id="playback-switch",
+                                label="Replay recorded run",
+                                value=False,
+                            ),
+                            width=3,
+                        ),
+                        dbc.Col(
+                            dcc.Input(
+                                id="trajectory-name",
+                                type="text",
+                                placeholder="trajectory name",
+                                style={"width": "100%"},
+                            ),
+                            width=3,
+                        ),
+                        dbc.Col(
+                            [
+                                html.Span("Ticks per frame: "),
+                                # negative values play backwards
+                                dcc.Input(
+                                    id="playback-speed",
+                                    type="number",
+                                    value=1,
+                                    style={"width": "40%"},
+                                ),
+                            ],
+                            width=3,
+                        ),
+                    ]
+                ),
+                dcc.Slider(
+                    id="playback-slider",
+                    min=0,
+                    max=0,
+                    step=1,
+                    value=0,
+                    marks=None,
+                    tooltip={"placement": "bottom", "always_visible": True},
+                ),
+            ],
+            style={
+                "margin-top": "20px",
+                "padding": "10px",
+                "background-color": "#f8f9fa",
+                "border-radius": "5px",
+            },
+        ),
         html.Div(
             [
                 # html.Div("Speed of simulation:", style={"margin-bottom": "5px"}),
                 html.Br(),
                 dcc.Graph(id="highway-graph-statistics", config={"displayModeBar": False}),
+                # Per-phase tick timings, filled while "Show performance" is on
+                html.Div(id="perf-panel"),
             ]
         ),
         dcc.Interval(
             id="interval-component", interval=FRAME_RATE, n_intervals=0, disabled=True
         ),
+        dcc.Interval(
+            id="playback-interval",
+            interval=PLAYBACK_FRAME_RATE,
+            n_intervals=0,
+            disabled=True,
+        ),
+        # Stretch of road the highway graph is zoomed to
+        dcc.Store(id="viewport"),
+        # What the browser currently shows, used to send only the changes
+        dcc.Store(id="render-state"),
     ],
     style={"padding": "20px", "font-family": "Arial"},
 )
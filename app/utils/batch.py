@@ -0,0 +1,344 @@
+# In[1]: Imports
+# batch.py
+import argparse
+import csv
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from app.utils.highway_traffic_and_car_sim import HIGHWAY_LENGTH, HighwayTrafficSimulation
+from app.utils.spawning import SPEED_DISTRIBUTIONS, parse_driver_mix
+from app.utils.steady_state import STEADY_STATE_COLUMNS, SteadyStateDetector
+
+# In[2]: Scenario runner
+# One compact record per scenario, so results pickle cheaply between processes
+RESULT_DTYPE = np.dtype(
+    [
+        ("simulation_type", "U16"),
+        ("spawn_rate", np.int32),
+        ("lanes", np.int32),
+        ("seed", np.int64),
+        ("steps", np.int32),
+        ("engine", "U10"),
+        ("highway_length", np.float64),
+        ("final_num_cars", np.int32),
+        ("mean_num_cars", np.float64),
+        ("mean_avg_speed", np.float64),
+        ("mean_avg_density", np.float64),
+        ("mean_happiness_factor", np.float64),
+        ("final_avg_time_to_exit", np.float64),
+        # cars that left the highway over the whole run, per driver type
+        ("exited_normal", np.int64),
+        ("exited_aggressive", np.int64),
+        ("exited_cautious", np.int64),
+        # tick the run was found steady at, -1 if it never was
+        ("converged_at", np.int64),
+    ]
+    + [(f"steady_{name}", np.float64) for name in STEADY_STATE_COLUMNS]
+)
+
+
+def _checkpoint_path(
+    checkpoint_dir,
+    simulation_type,
+    spawn_rate,
+    lanes,
+    seed,
+    engine,
+    highway_length,
+    spawning=None,
+    driver_mix=None,
+    speed_distribution="uniform",
+):
+    name = f"{simulation_type}_{spawn_rate}_{lanes}_{seed}_{engine}_{highway_length:g}"
+    # runs with other new cars must not resume from each other's checkpoints
+    if spawning is None:
+        spawning = HighwayTrafficSimulation.default_spawning(driver_mix, speed_distribution)
+    if spawning != "batched":
+        name += f"_{spawning}"
+    if driver_mix is not None:
+        name += "_" + "-".join(f"{key}{value:g}" for key, value in sorted(driver_mix.items()))
+    if speed_distribution != "uniform":
+        name += f"_{speed_distribution}"
+    return os.path.join(checkpoint_dir, f"{name}.npz")
+
+
+def run_scenario(
+    simulation_type,
+    spawn_rate,
+    lanes,
+    seed,
+    steps,
+    engine="object",
+    checkpoint_dir=None,
+    checkpoint_interval=1000,
+    highway_length=HIGHWAY_LENGTH,
+    stop_when_steady=False,
+    steady_window=200,
+    steady_tolerance=0.02,
+    spawning=None,
+    driver_mix=None,
+    speed_distribution="uniform",
+):
+    """Runs one headless simulation and returns its aggregate statistics.
+
+    The simulation draws from its own random stream seeded with `seed`, so the
+    result does not depend on which process runs it or in which order. With a
+    `checkpoint_dir`, the run is saved there every `checkpoint_interval` steps
+    and an interrupted run picks up from its last checkpoint.
+
+    A SteadyStateDetector watches every run and the result reports when it
+    converged and the steady values of STEADY_STATE_COLUMNS. With
+    `stop_when_steady`, the run also ends there instead of after `steps`.
+
+    `spawning`, `driver_mix` and `speed_distribution` choose how new cars are
+    drawn, see HighwayTrafficSimulation. Without a `spawning`, the engine's
+    default_spawning is used.
+    """
+    path = None
+    if checkpoint_dir is not None:
+        path = _checkpoint_path(
+            checkpoint_dir,
+            simulation_type,
+            spawn_rate,
+            lanes,
+            seed,
+            engine,
+            highway_length,
+            spawning,
+            driver_mix,
+            speed_distribution,
+        )
+
+    if path is not None and os.path.exists(path):
+        traffic_sim = HighwayTrafficSimulation.load_checkpoint(path)
+    else:
+        traffic_sim = HighwayTrafficSimulation(
+            engine=engine,
+            highway_length=highway_length,
+            results_dir=None,
+            seed=seed,
+            autosave_path=path,
+            autosave_interval=checkpoint_interval,
+            steady_state=SteadyStateDetector(
+                window=steady_window, tolerance=steady_tolerance
+            ),
+            spawning=spawning,
+            driver_mix=driver_mix,
+            speed_distribution=speed_distribution,
+        )
+    detector = traffic_sim.steady_state
+
+    while traffic_sim.time_elapsed < steps:
+        if stop_when_steady and detector.converged:
+            break
+        traffic_sim.update(simulation_type, spawn_rate, lanes)
+
+    # an early stop records the steps actually run
+    return summarize(
+        traffic_sim, simulation_type, spawn_rate, lanes, seed, traffic_sim.time_elapsed, engine
+    )
+
+
+def summarize(traffic_sim, simulation_type, spawn_rate, lanes, seed, steps, engine):
+    """Reduces the per-tick statistics of a finished run to one RESULT_DTYPE row."""
+    stats = traffic_sim.statistics
+    detector = traffic_sim.steady_state
+    steady_values = (
+        detector.steady_values
+        if detector is not None and detector.converged
+        else dict.fromkeys(STEADY_STATE_COLUMNS, np.nan)
+    )
+
+    def mean(name):
+        return float(stats.mean(name))
+
+    return (
+        simulation_type,
+        spawn_rate,
+        lanes,
+        seed,
+        steps,
+        engine,
+        traffic_sim.highway_length,
+        len(traffic_sim.cars),
+        mean("num_cars"),
+        mean("avg_speed"),
+        mean("avg_density"),
+        mean("happiness_factor"),
+        float(stats.last("avg_time_to_exit")) if len(stats) else 0.0,
+        *traffic_sim.exits_by_driver.tolist(),
+        detector.converged_at if detector is not None and detector.converged else -1,
+        *(steady_values[name] for name in STEADY_STATE_COLUMNS),
+    )
+
+
+def _run_packed(scenario):
+    return run_scenario(*scenario)
+
+
+def scenario_grid(simulation_types, spawn_rates, lanes, seeds):
+    """Yields every (simulation type, spawn rate, lanes, seed) combination."""
+    return itertools.product(simulation_types, spawn_rates, lanes, seeds)
+
+
+def run_sweep(
+    scenarios,
+    steps,
+    engine="object",
+    workers=1,
+    checkpoint_dir=None,
+    checkpoint_interval=1000,
+    highway_length=HIGHWAY_LENGTH,
+    stop_when_steady=False,
+    steady_window=200,
+    steady_tolerance=0.02,
+    spawning=None,
+    driver_mix=None,
+    speed_distribution="uniform",
+):
+    """Runs independent scenarios and returns a RESULT_DTYPE structured array.
+
+    With more than one worker the scenarios are fanned out over a process
+    pool. Every scenario carries its own seed, so the results are identical
+    to a sequential run. Scenarios with a checkpoint in `checkpoint_dir`
+    resume from it, see run_scenario.
+    """
+    jobs = [
+        (
+            *scenario,
+            steps,
+            engine,
+            checkpoint_dir,
+            checkpoint_interval,
+            highway_length,
+            stop_when_steady,
+            steady_window,
+            steady_tolerance,
+            spawning,
+            driver_mix,
+            speed_distribution,
+        )
+        for scenario in scenarios
+    ]
+
+    if workers == 1:
+        rows = [_run_packed(job) for job in jobs]
+    else:
+        workers = workers or os.cpu_count()
+        # hand out several scenarios per task to amortize the pickling overhead
+        chunksize = max(1, len(jobs) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(_run_packed, jobs, chunksize=chunksize))
+
+    return np.array(rows, dtype=RESULT_DTYPE)
+
+
+def write_results(results, output):
+    """Writes a RESULT_DTYPE array to a single csv file."""
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(RESULT_DTYPE.names)
+        writer.writerows(results.tolist())
+
+
+# In[3]: Command line interface
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run a grid of highway traffic simulations without the Dash app."
+    )
+    parser.add_argument(
+        "--simulation-types",
+        nargs="+",
+        default=list(HighwayTrafficSimulation.SIMULATION_TYPES),
+        choices=HighwayTrafficSimulation.SIMULATION_TYPES,
+    )
+    parser.add_argument("--spawn-rates", nargs="+", type=int, default=[50])
+    parser.add_argument("--lanes", nargs="+", type=int, default=[5])
+    parser.add_argument("--seeds", nargs="+", type=int, default=[0])
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument(
+        "--engine", default="object", choices=HighwayTrafficSimulation.ENGINES
+    )
+    parser.add_argument("--highway-length", type=float, default=HIGHWAY_LENGTH)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes, 0 uses every CPU core",
+    )
+    parser.add_argument(
+        "--checkpoint-dir",
+        default=None,
+        help="save every scenario here and resume interrupted ones on the next run",
+    )
+    parser.add_argument(
+        "--checkpoint-interval",
+        type=int,
+        default=1000,
+        help="steps between two checkpoints of a scenario",
+    )
+    parser.add_argument(
+        "--spawning",
+        default=None,
+        choices=HighwayTrafficSimulation.SPAWNING,
+        help="batched draws every tick's new cars at once, the default is sequential "
+        "unless --driver-mix or --speed-distribution is given",
+    )
+    parser.add_argument(
+        "--driver-mix",
+        type=parse_driver_mix,
+        default=None,
+        help='weights of the driver types of new cars, e.g. "normal=2,aggressive=1"',
+    )
+    parser.add_argument(
+        "--speed-distribution", default="uniform", choices=tuple(SPEED_DISTRIBUTIONS)
+    )
+    parser.add_argument(
+        "--stop-when-steady",
+        action="store_true",
+        help="end every scenario once its statistics stop drifting, --steps at the latest",
+    )
+    parser.add_argument(
+        "--steady-window",
+        type=int,
+        default=200,
+        help="ticks per window compared by the steady-state test",
+    )
+    parser.add_argument(
+        "--steady-tolerance",
+        type=float,
+        default=0.02,
+        help="relative change between windows still counted as steady",
+    )
+    parser.add_argument("--output", default="batch_results.csv")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = run_sweep(
+        scenario_grid(args.simulation_types, args.spawn_rates, args.lanes, args.seeds),
+        args.steps,
+        engine=args.engine,
+        workers=args.workers,
+        checkpoint_dir=args.checkpoint_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        highway_length=args.highway_length,
+        stop_when_steady=args.stop_when_steady,
+        steady_window=args.steady_window,
+        steady_tolerance=args.steady_tolerance,
+        spawning=args.spawning,
+        driver_mix=args.driver_mix,
+        speed_distribution=args.speed_distribution,
+    )
+
+    write_results(results, args.output)
+    print(f"Wrote {len(results)} scenarios to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
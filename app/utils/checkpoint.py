@@ -0,0 +1,68 @@
+# In[1]:
+# checkpoint.py
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from app.utils.vectorized_engine import CarArrays
+
+CHECKPOINT_VERSION = 2
+
+# In[2]:
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f"{type(value).__name__} cannot be stored in a checkpoint")
+
+
+def write_checkpoint(path, arrays, state, columns=None):
+    """Writes car arrays, named data columns and a state dict to an .npz file.
+
+    Every car attribute and every entry of `columns` is stored as its own
+    uncompressed array, so loading is a handful of contiguous reads no
+    matter how many cars there are. `state` is stored as JSON and may only
+    hold JSON types, NumPy scalars and NumPy arrays. The file is written
+    next to `path` first and then moved into place, so a crash during
+    autosave never leaves a truncated checkpoint behind.
+    """
+    entries = {f"car_{name}": getattr(arrays, name) for name in CarArrays.FIELDS}
+    for name, column in (columns or {}).items():
+        entries[f"data_{name}"] = column
+    try:
+        text = json.dumps({"version": CHECKPOINT_VERSION, **state}, default=_to_json)
+    except TypeError as error:
+        raise ValueError(f"Cannot write checkpoint: {error}") from None
+    entries["state"] = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".npz")
+    with os.fdopen(fd, "wb") as f:
+        np.savez(f, **entries)
+    os.replace(tmp_path, path)
+
+
+def read_checkpoint(path):
+    """Reads a file written by write_checkpoint, returning (arrays, state, columns).
+
+    Nothing in the file is unpickled, so reading a checkpoint never runs
+    code from it.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        state = json.loads(data["state"].tobytes().decode("utf-8"))
+        version = state.pop("version", None)
+        if version != CHECKPOINT_VERSION:
+            raise ValueError(
+                f"{path} has checkpoint version {version}, expected {CHECKPOINT_VERSION}"
+            )
+        arrays = CarArrays()
+        for name, dtype in CarArrays.FIELDS.items():
+            setattr(arrays, name, data[f"car_{name}"].astype(dtype, copy=False))
+        columns = {
+            name[len("data_") :]: data[name] for name in data.files if name.startswith("data_")
+        }
+    return arrays, state, columns
@@ -0,0 +1,388 @@
+# In[1]: Imports
+# ensemble.py
+import argparse
+import csv
+
+import numpy as np
+
+from app.utils.highway_traffic_and_car_sim import HIGHWAY_LENGTH, HighwayTrafficSimulation
+from app.utils.jit_kernels import step_penguin_jit, step_simple_jit
+from app.utils.lattice import SLOWDOWN_PROBABILITY, step_lattice
+from app.utils.spatial_index import CellList
+from app.utils.spawning import SPEED_DISTRIBUTIONS, Spawner, parse_driver_mix
+from app.utils.statistics_store import RunningMoments
+from app.utils.vectorized_engine import (
+    CarArrays,
+    huddle_joiners,
+    step_individualistic,
+    step_penguin,
+    step_simple,
+)
+
+# Statistics summarized over the replicas of an ensemble
+ENSEMBLE_METRICS = ("avg_speed", "avg_density", "happiness_factor", "avg_time_to_exit")
+CONFIDENCE_Z = 1.96  # half width of a two-sided 95% interval, in standard errors
+
+# In[2]: Replicas stepped together
+class Ensemble:
+    """Independent highways advanced together in one CarArrays.
+
+    Replica r numbers its lanes r * lane_stride + 1 .. r * lane_stride +
+    lane_value, leaving an empty lane between replicas. The lane-ordered
+    kernels of the array engines therefore never let a car of one replica
+    follow a car of another, and a single kernel call steps every replica.
+
+    Every tick, each replica's avg_speed, avg_density, happiness_factor and
+    avg_time_to_exit are added to running totals over the ticks it had cars
+    on the highway. These are the quantities batch.summarize averages, and no
+    per-tick rows are kept.
+
+    One Spawner draws the new cars of every replica, with its `driver_mix`
+    and `speed_distribution`. An ensemble is reproducible from its seed but
+    does not replay the random stream of a HighwayTrafficSimulation with the
+    same seed. The number of draws per tick does not depend on the driver
+    model, so ensembles of different models with the same seed spawn
+    identical traffic.
+    """
+
+    def __init__(
+        self,
+        replicas,
+        lane_value,
+        engine="vectorized",
+        highway_length=HIGHWAY_LENGTH,
+        seed=None,
+        driver_mix=None,
+        speed_distribution="uniform",
+        slowdown_probability=SLOWDOWN_PROBABILITY,
+    ):
+        if engine not in HighwayTrafficSimulation.ARRAY_ENGINES:
+            raise ValueError(
+                f"Ensembles need an array engine, expected one of "
+                f"{HighwayTrafficSimulation.ARRAY_ENGINES}, got {engine!r}"
+            )
+        if highway_length <= 0:
+            raise ValueError(f"highway_length must be positive, got {highway_length!r}")
+        self.replicas = replicas
+        self.lane_value = lane_value
+        self.lane_stride = lane_value + 1
+        self.engine = engine
+        self.highway_length = highway_length
+        self.spawner = Spawner(
+            seed, driver_mix=driver_mix, speed_distribution=speed_distribution
+        )
+        # the lattice types dawdle from a child stream, leaving spawning as is
+        self.slowdown_probability = slowdown_probability
+        self.lattice_rng = self.spawner.rng.spawn(1)[0]
+
+        self.cars = CarArrays()
+        # cell list the penguin type finds neighbouring huddles with
+        self.spatial_index = CellList(highway_length)
+        self.time_elapsed = 0
+        self.next_car_id = 0
+
+        # travel times of the cars that left the highway, per replica
+        self.exit_total = np.zeros(replicas)
+        self.exit_count = np.zeros(replicas, dtype=np.int64)
+        # running totals of every metric over the ticks with cars
+        self.totals = {name: np.zeros(replicas) for name in ENSEMBLE_METRICS}
+        self.ticks_with_cars = np.zeros(replicas, dtype=np.int64)
+
+    def replica_of(self, lane):
+        """Returns the replica every (ensemble) lane number belongs to."""
+        return (lane - 1) // self.lane_stride
+
+    def _spawn(self, spawn_rate):
+        new, replica = self.spawner.spawn(spawn_rate, self.lane_value, self.replicas)
+        new.lane += replica * self.lane_stride
+        new.id = np.arange(self.next_car_id, self.next_car_id + len(new))
+        self.next_car_id += len(new)
+        self.cars.append_arrays(new)
+
+    def _accumulate(self):
+        """Adds this tick's statistics of every replica to the running totals."""
+        cars = self.cars
+        replica = self.replica_of(cars.lane)
+        num_cars = np.bincount(replica, minlength=self.replicas)
+        has_cars = num_cars > 0
+        per_car = np.maximum(num_cars, 1)
+
+        cars.time += 1
+
+        values = {
+            "avg_speed": np.bincount(replica, weights=cars.speed, minlength=self.replicas)
+            / per_car,
+            "avg_density": num_cars / self.highway_length,
+            "happiness_factor": np.bincount(
+                replica, weights=cars.happiness, minlength=self.replicas
+            )
+            / per_car,
+            "avg_time_to_exit": np.divide(
+                self.exit_total,
+                self.exit_count,
+                out=np.zeros(self.replicas),
+                where=self.exit_count > 0,
+            ),
+        }
+        for name, value in values.items():
+            self.totals[name] += np.where(has_cars, value, 0)
+        self.ticks_with_cars += has_cars
+
+    def update(self, simulation_type, spawn_rate):
+        """Advances every replica one time step with the given driver model."""
+        cars = self.cars
+        if simulation_type == "simple":
+            (step_simple_jit if self.engine == "jit" else step_simple)(cars)
+        elif simulation_type == "individualistic":
+            step_individualistic(
+                cars,
+                self.lane_value,
+                lane_offset=self.replica_of(cars.lane) * self.lane_stride,
+            )
+        elif simulation_type == "penguin":
+            if cars.is_in_huddle.any():
+                self.spatial_index.rebuild(cars.lane, cars.position)
+                cars.is_in_huddle |= huddle_joiners(
+                    self.spatial_index,
+                    cars.lane,
+                    cars.position,
+                    cars.safe_distance,
+                    cars.is_in_huddle,
+                )
+            (step_penguin_jit if self.engine == "jit" else step_penguin)(cars)
+        elif simulation_type in HighwayTrafficSimulation.LATTICE_VARIANTS:
+            step_lattice(
+                cars,
+                self.lane_value,
+                self.highway_length,
+                self.lattice_rng,
+                variant=HighwayTrafficSimulation.LATTICE_VARIANTS[simulation_type],
+                slowdown_probability=self.slowdown_probability,
+                lane_offset=self.replica_of(cars.lane) * self.lane_stride,
+            )
+        else:
+            raise ValueError(
+                f"Unknown simulation type {simulation_type!r}, expected one of "
+                f"{HighwayTrafficSimulation.SIMULATION_TYPES}"
+            )
+
+        exited = cars.position >= self.highway_length
+        if exited.any():
+            replica = self.replica_of(cars.lane[exited])
+            self.exit_total += np.bincount(
+                replica, weights=cars.time[exited], minlength=self.replicas
+            )
+            self.exit_count += np.bincount(replica, minlength=self.replicas)
+            cars.compact(~exited)
+        self._spawn(spawn_rate)
+        if len(cars):
+            self._accumulate()
+        self.time_elapsed += 1
+
+    def run(self, simulation_type, spawn_rate, steps):
+        while self.time_elapsed < steps:
+            self.update(simulation_type, spawn_rate)
+        return self
+
+    def run_means(self):
+        """Returns {metric: time average of every replica}, 0 for replicas
+        that never had a car."""
+        ticks = np.maximum(self.ticks_with_cars, 1)
+        return {name: total / ticks for name, total in self.totals.items()}
+
+
+# In[3]: Confidence intervals over many replicas
+def run_ensemble(
+    simulation_type,
+    spawn_rate,
+    lanes,
+    replicas,
+    steps,
+    seed=0,
+    engine="vectorized",
+    highway_length=HIGHWAY_LENGTH,
+    batch_size=None,
+    driver_mix=None,
+    speed_distribution="uniform",
+):
+    """Runs `replicas` independent simulations and returns {metric: RunningMoments}.
+
+    The replicas are stepped `batch_size` at a time, all at once by default.
+    Each batch only hands its per-replica run means to the moments, so memory
+    does not grow with the number of replicas. Batches draw from independent
+    streams spawned from `seed`.
+    """
+    batch_size = batch_size or replicas
+    batches = range(0, replicas, batch_size)
+    streams = np.random.SeedSequence(seed).spawn(len(batches))
+
+    moments = {name: RunningMoments() for name in ENSEMBLE_METRICS}
+    for start, stream in zip(batches, streams):
+        ensemble = Ensemble(
+            min(batch_size, replicas - start),
+            lanes,
+            engine=engine,
+            highway_length=highway_length,
+            seed=stream,
+            driver_mix=driver_mix,
+            speed_distribution=speed_distribution,
+        )
+        ensemble.run(simulation_type, spawn_rate, steps)
+        for name, means in ensemble.run_means().items():
+            moments[name].add_many(means)
+    return moments
+
+
+# One record per driver model: the mean of every metric over the replicas,
+# its standard deviation and the half width of its 95% confidence interval
+ENSEMBLE_DTYPE = np.dtype(
+    [
+        ("simulation_type", "U16"),
+        ("spawn_rate", np.int32),
+        ("lanes", np.int32),
+        ("replicas", np.int32),
+        ("steps", np.int32),
+        ("seed", np.int64),
+        ("engine", "U10"),
+        ("highway_length", np.float64),
+    ]
+    + [
+        (f"{statistic}_{name}", np.float64)
+        for name in ENSEMBLE_METRICS
+        for statistic in ("mean", "std", "ci95")
+    ]
+)
+
+
+def compare_models(
+    simulation_types,
+    spawn_rate,
+    lanes,
+    replicas,
+    steps,
+    seed=0,
+    engine="vectorized",
+    highway_length=HIGHWAY_LENGTH,
+    batch_size=None,
+    driver_mix=None,
+    speed_distribution="uniform",
+):
+    """Runs an ensemble of every driver model and returns an ENSEMBLE_DTYPE array.
+
+    Every model gets the same seed, so all of them see the same spawned
+    traffic and their differences are not blurred by spawning noise.
+    """
+    rows = []
+    for simulation_type in simulation_types:
+        moments = run_ensemble(
+            simulation_type,
+            spawn_rate,
+            lanes,
+            replicas,
+            steps,
+            seed=seed,
+            engine=engine,
+            highway_length=highway_length,
+            batch_size=batch_size,
+            driver_mix=driver_mix,
+            speed_distribution=speed_distribution,
+        )
+        rows.append(
+            (
+                simulation_type,
+                spawn_rate,
+                lanes,
+                replicas,
+                steps,
+                seed,
+                engine,
+                highway_length,
+                *(
+                    value
+                    for name in ENSEMBLE_METRICS
+                    for value in (
+                        moments[name].mean,
+                        moments[name].std,
+                        CONFIDENCE_Z * moments[name].sem,
+                    )
+                ),
+            )
+        )
+    return np.array(rows, dtype=ENSEMBLE_DTYPE)
+
+
+def write_results(results, output):
+    """Writes an ENSEMBLE_DTYPE array to a single csv file."""
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(ENSEMBLE_DTYPE.names)
+        writer.writerows(results.tolist())
+
+
+# In[4]: Command line interface
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compare driver models over many replicas with 95% confidence intervals."
+    )
+    parser.add_argument(
+        "--simulation-types",
+        nargs="+",
+        default=list(HighwayTrafficSimulation.SIMULATION_TYPES),
+        choices=HighwayTrafficSimulation.SIMULATION_TYPES,
+    )
+    parser.add_argument("--spawn-rate", type=int, default=50)
+    parser.add_argument("--lanes", type=int, default=5)
+    parser.add_argument("--replicas", type=int, default=100)
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=None,
+        help="replicas stepped together, by default all of them",
+    )
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--engine", default="vectorized", choices=HighwayTrafficSimulation.ARRAY_ENGINES
+    )
+    parser.add_argument("--highway-length", type=float, default=HIGHWAY_LENGTH)
+    parser.add_argument(
+        "--driver-mix",
+        type=parse_driver_mix,
+        default=None,
+        help='weights of the driver types of new cars, e.g. "normal=2,aggressive=1"',
+    )
+    parser.add_argument(
+        "--speed-distribution", default="uniform", choices=tuple(SPEED_DISTRIBUTIONS)
+    )
+    parser.add_argument("--output", default="ensemble_results.csv")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    results = compare_models(
+        args.simulation_types,
+        args.spawn_rate,
+        args.lanes,
+        args.replicas,
+        args.steps,
+        seed=args.seed,
+        engine=args.engine,
+        highway_length=args.highway_length,
+        batch_size=args.batch_size,
+        driver_mix=args.driver_mix,
+        speed_distribution=args.speed_distribution,
+    )
+
+    for row in results:
+        print(row["simulation_type"])
+        for name in ENSEMBLE_METRICS:
+            print(f"  {name:18} {row[f'mean_{name}']:10.3f} ± {row[f'ci95_{name}']:.3f}")
+
+    write_results(results, args.output)
+    print(f"Wrote {len(results)} driver models to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
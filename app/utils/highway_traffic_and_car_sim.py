@@ -1,188 +1,756 @@
 # In[1]:
 # highway_simulation.py
+import itertools
 import random
+from bisect import bisect_left, bisect_right
+
 import numpy as np
 
+from app.utils.checkpoint import read_checkpoint, write_checkpoint
+from app.utils.lane_index import LaneIndex
+from app.utils.lattice import SLOWDOWN_PROBABILITY, step_lattice
+from app.utils.profiling import PhaseTimer
+from app.utils.spatial_index import CellList
+from app.utils.spawning import Spawner
+from app.utils.jit_kernels import step_simple_jit, step_penguin_jit
+from app.utils.statistics_sinks import SINKS, make_sink
+from app.utils.statistics_store import RunningMean, StatisticsStore
+from app.utils.steady_state import SteadyStateDetector
+from app.utils.trajectory import TrajectoryWriter
+from app.utils.vectorized_engine import (
+    CAR_COLORS,
+    DRIVER_CODES,
+    DRIVER_PROFILES,
+    DRIVER_TYPES,
+    CarArrays,
+    huddle_joiners,
+    step_simple,
+    step_individualistic,
+    step_penguin,
+)
+
 # Highway parameters
-HIGHWAY_LENGTH = 100
+HIGHWAY_LENGTH = 100  # default length of a simulation's highway
 # ROAD_WIDTH = 6
 SIDE_WIDTH = 2
 # ROAD_LANES = ROAD_WIDTH  # Using the same number for lanes as road width
 
 # In[2]:
+# ids of cars created outside a simulation, which numbers its own
+_car_ids = itertools.count()
+
+
 class Car:
-    def __init__(self, lane, position, speed, type="car", driver_type="normal"):
+    """One car on the highway.
+
+    Cars keep their attributes in slots instead of a per-instance dict. The
+    driver profile and the color are small integer codes into the shared
+    DRIVER_PROFILES and CAR_COLORS tables.
+    """
+
+    __slots__ = (
+        "lane",
+        "position",
+        "speed",
+        "type",
+        "id",
+        "color_code",
+        "driver_code",
+        "time_in_huddle",
+        "is_in_huddle",
+        "ideal_speed",
+        "time",
+        "happiness",
+    )
+
+    def __init__(
+        self, lane, position, speed, type="car", driver_type="normal", rng=random, id=None
+    ):
         self.lane = lane
         self.position = position
         self.speed = speed
         self.type = type
-        self.id = random.randint(0, 10000000000000)
-        self.color = f"rgb({random.randint(50,200)}, {random.randint(50,200)}, {random.randint(50,200)})"
-        self.driver_type = driver_type  # normal, aggressive, cautious
+        self.id = next(_car_ids) if id is None else id
+        self.color_code = rng.randrange(len(CAR_COLORS))
+        self.driver_code = DRIVER_CODES[driver_type]  # normal, aggressive, cautious
 
         # penguin information
         self.time_in_huddle = 0
         self.is_in_huddle = False
 
-        if driver_type == "normal":
-            self.safe_distance = 2
-            self.acceleration = 0.5
-            self.deceleration = 1.0
-        elif driver_type == "aggressive":
-            self.safe_distance = 1
-            self.acceleration = 1.0
-            self.deceleration = 1.5
-        elif driver_type == "cautious":
-            self.safe_distance = 3
-            self.acceleration = 0.3 
-            self.deceleration = 0.8
-
         self.ideal_speed = speed
         self.time = 0
         self.happiness = 10
 
+    @property
+    def driver_type(self):
+        return DRIVER_TYPES[self.driver_code]
+
+    @property
+    def color(self):
+        return CAR_COLORS[self.color_code]
+
+    @property
+    def safe_distance(self):
+        return DRIVER_PROFILES[self.driver_code].safe_distance
+
+    @property
+    def acceleration(self):
+        return DRIVER_PROFILES[self.driver_code].acceleration
+
+    @property
+    def deceleration(self):
+        return DRIVER_PROFILES[self.driver_code].deceleration
+
+
+def _cars_from_arrays(arrays):
+    """Rebuilds Car objects from CarArrays without drawing new ids or colors."""
+    cars = []
+    new_car = Car.__new__
+    for (
+        lane,
+        position,
+        speed,
+        id,
+        color_code,
+        driver_code,
+        time_in_huddle,
+        is_in_huddle,
+        ideal_speed,
+        time,
+        happiness,
+    ) in zip(
+        arrays.lane.tolist(),
+        arrays.position.tolist(),
+        arrays.speed.tolist(),
+        arrays.id.tolist(),
+        arrays.color_code.tolist(),
+        arrays.driver_code.tolist(),
+        arrays.time_in_huddle.tolist(),
+        arrays.is_in_huddle.tolist(),
+        arrays.ideal_speed.tolist(),
+        arrays.time.tolist(),
+        arrays.happiness.tolist(),
+    ):
+        car = new_car(Car)
+        car.lane = lane
+        car.position = position
+        car.speed = speed
+        car.type = "car"
+        car.id = id
+        car.color_code = color_code
+        car.driver_code = driver_code
+        car.time_in_huddle = time_in_huddle
+        car.is_in_huddle = is_in_huddle
+        car.ideal_speed = ideal_speed
+        car.time = time
+        car.happiness = happiness
+        cars.append(car)
+    return cars
+
 # In[3]:
 class HighwayTrafficSimulation:
-    def __init__(self):
-        self.cars = []
+    ENGINES = ("object", "vectorized", "jit")
+    # engines that keep their cars in CarArrays; "jit" runs the simple and
+    # penguin models through numba kernels when numba is installed
+    ARRAY_ENGINES = ("vectorized", "jit")
+    SIMULATION_TYPES = (
+        "simple",
+        "individualistic",
+        "penguin",
+        "lattice",
+        "lattice_penguin",
+        "lattice_lanes",
+    )
+    # lattice cellular automaton variant behind every lattice simulation type
+    LATTICE_VARIANTS = {
+        "lattice": "plain",
+        "lattice_penguin": "penguin",
+        "lattice_lanes": "lane_change",
+    }
+    # constructor arguments a checkpoint restores the simulation with
+    CHECKPOINT_SETTINGS = (
+        "engine",
+        "highway_length",
+        "results_dir",
+        "seed",
+        "sink",
+        "flush_interval",
+        "statistics_retention",
+        "statistics_downsample",
+        "autosave_path",
+        "autosave_interval",
+        "trajectory_path",
+        "trajectory_chunk",
+        "trajectory_max_bytes",
+        "spawning",
+        "driver_mix",
+        "speed_distribution",
+        "slowdown_probability",
+    )
+    # "batched" draws every tick's new cars in one vectorized call,
+    # "sequential" spawns them lane by lane as earlier versions did
+    SPAWNING = ("batched", "sequential")
+
+    @staticmethod
+    def default_spawning(driver_mix=None, speed_distribution="uniform"):
+        """Returns the spawning used when none is given.
+
+        Runs spawn sequentially, so a seed gives the same run on every
+        engine and the runs seeded before batched spawning stay as they
+        were. Only a custom driver mix or speed distribution, which
+        sequential spawning cannot draw, spawns batched.
+        """
+        if driver_mix is not None or speed_distribution != "uniform":
+            return "batched"
+        return "sequential"
+
+    def __init__(
+        self,
+        engine="object",
+        highway_length=HIGHWAY_LENGTH,
+        results_dir="../../results",
+        seed=None,
+        sink="csv",
+        flush_interval=50,
+        statistics_retention=10_000,
+        statistics_downsample=10,
+        autosave_path=None,
+        autosave_interval=1000,
+        trajectory_path=None,
+        trajectory_chunk=100,
+        trajectory_max_bytes=None,
+        profile=False,
+        steady_state=None,
+        spawning=None,
+        driver_mix=None,
+        speed_distribution="uniform",
+        slowdown_probability=SLOWDOWN_PROBABILITY,
+    ):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}, expected one of {self.ENGINES}")
+        self.engine = engine
+        if spawning is None:
+            spawning = self.default_spawning(driver_mix, speed_distribution)
+        if spawning not in self.SPAWNING:
+            raise ValueError(f"Unknown spawning {spawning!r}, expected one of {self.SPAWNING}")
+        if spawning == "sequential" and (driver_mix is not None or speed_distribution != "uniform"):
+            raise ValueError("driver_mix and speed_distribution need batched spawning")
+        self.spawning = spawning
+        # share of every driver type and desired speed distribution of new cars
+        self.driver_mix = driver_mix
+        self.speed_distribution = speed_distribution
+        # chance a car dawdles in the lattice simulation types
+        self.slowdown_probability = slowdown_probability
+        if highway_length <= 0:
+            raise ValueError(f"highway_length must be positive, got {highway_length!r}")
+        self.highway_length = highway_length
+        # directory of the per-type statistics files, None disables them
+        self.results_dir = results_dir
+        # statistics backend ("csv", "npy", "npz" or "parquet") and how many
+        # ticks are buffered before they are appended to disk
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.sinks = {}
+        # number of full-resolution ticks kept in memory, and the block size
+        # older ticks are averaged over before they are dropped
+        self.statistics_retention = statistics_retention
+        self.statistics_downsample = statistics_downsample
+        self.seed = seed
+        # checkpoint written every autosave_interval ticks, None disables it
+        self.autosave_path = autosave_path
+        self.autosave_interval = autosave_interval
+        # directory the per-tick car states are recorded to for playback,
+        # None disables it
+        self.trajectory_path = trajectory_path
+        self.trajectory_chunk = trajectory_chunk
+        # recording stops once the car records reach this size, None records
+        # the whole run
+        self.trajectory_max_bytes = trajectory_max_bytes
+        # per-phase tick timings, off unless asked for
+        self.profiler = PhaseTimer(enabled=profile)
+        # SteadyStateDetector fed every recorded tick, None disables it
+        self.steady_state = steady_state
+
+        self._init_state()
+
+    def _init_state(self):
+        """Creates an empty highway."""
+        # a seed gives the simulation its own random stream, independent of
+        # the global random module and of any other simulation in the process
+        self.rng = random if self.seed is None else random.Random(self.seed)
+        # the dawdling of the lattice types has its own stream, so switching
+        # models does not change which cars spawn
+        self.lattice_rng = np.random.default_rng(self.seed).spawn(1)[0]
+        self.spawner = None
+        if self.spawning == "batched":
+            self.spawner = Spawner(
+                self.seed,
+                driver_mix=self.driver_mix,
+                speed_distribution=self.speed_distribution,
+            )
+
+        # the array engines keep every car attribute in NumPy arrays
+        self.cars = CarArrays() if self.engine in self.ARRAY_ENGINES else []
+        # the object engine keeps its cars ordered per lane between ticks
+        self.lane_index = LaneIndex()
+        # cell list over (lane, position), rebuilt lazily once per tick
+        self._spatial_index = CellList(self.highway_length)
+        self._spatial_index_stale = True
         self.time_elapsed = 0
-        self.statistics = {
-            "time_elapsed": [],
-            "num_cars": [],
-            "avg_speed": [],
-            "avg_density": [],
-            "cars_on_highway": [],
-            "lane_distribution": [],
-            "avg_num_cars_per_lane": [],
-            "happiness_factor": [],
-            "avg_time_to_exit": [],
-        }
+        # cars are numbered in spawn order
+        self.next_car_id = 0
+        self.statistics = StatisticsStore(
+            retention=self.statistics_retention,
+            downsample=self.statistics_downsample,
+        )
+
+        # travel times of the cars that left the highway, kept as a running mean
+        self.cars_reached_destination = RunningMean()
+        # cars that left the highway per driver type, this tick and in total
+        self.tick_exits = np.zeros(len(DRIVER_TYPES), dtype=np.int64)
+        self.exits_by_driver = np.zeros(len(DRIVER_TYPES), dtype=np.int64)
+
+        if self.steady_state is not None:
+            self.steady_state.reset()
+
+        self.trajectory = None
+        if self.trajectory_path is not None:
+            self.trajectory = self._open_trajectory()
+
+    def _open_trajectory(self):
+        return TrajectoryWriter(
+            self.trajectory_path,
+            chunk_size=self.trajectory_chunk,
+            max_bytes=self.trajectory_max_bytes,
+            meta={
+                "seed": self.seed,
+                "engine": self.engine,
+                "highway_length": self.highway_length,
+                "spawning": self.spawning,
+                "driver_mix": self.driver_mix,
+            },
+        )
+
+    def start_recording(self, path):
+        """Records every tick from now on to a new trajectory at `path`."""
+        self.stop_recording()
+        self.trajectory_path = path
+        self.trajectory = self._open_trajectory()
 
-        self.cars_reached_destination = []
+    def stop_recording(self):
+        """Ends the recording, keeping the ticks written so far."""
+        if self.trajectory is not None:
+            self.trajectory.close()
+        self.trajectory = None
+        self.trajectory_path = None
 
     def _add_car(self, spawn_probability, lane_value):
         """Randomly adds a car based on the spawn probability."""
+        if self.spawner is not None:
+            return self._spawn_batch(spawn_probability, lane_value)
+
+        new_cars = []
         for lane in range(1, lane_value + 1):
-            if random.random() < (
+            if self.rng.random() < (
                 spawn_probability / 100 
             ):  # Convert slider value to probability
-                driver_type = random.choice(["normal", "aggressive", "cautious"])
+                driver_type = self.rng.choice(DRIVER_TYPES)
 
                 # Set speed based on driver type
-                if driver_type == "aggressive":
-                    desired_speed = random.randint(5, 10)
-                elif driver_type == "normal":
-                    desired_speed = random.randint(3, 8)
-                elif driver_type == "cautious":
-                    desired_speed = random.randint(2, 6)
-
-                self.cars.append(Car(lane, 0, desired_speed, driver_type=driver_type))
+                profile = DRIVER_PROFILES[DRIVER_CODES[driver_type]]
+                desired_speed = self.rng.randint(profile.min_speed, profile.max_speed)
+
+                new_cars.append(
+                    Car(
+                        lane,
+                        0,
+                        desired_speed,
+                        driver_type=driver_type,
+                        rng=self.rng,
+                        id=self.next_car_id,
+                    )
+                )
+                self.next_car_id += 1
+
+        if self.engine in self.ARRAY_ENGINES:
+            self.cars.append_cars(new_cars)
+        else:
+            self.cars.extend(new_cars)
+            self.lane_index.add(new_cars)
+
+    def _spawn_batch(self, spawn_probability, lane_value):
+        """Adds the cars of one Spawner draw to the car storage in bulk."""
+        new, _ = self.spawner.spawn(spawn_probability, lane_value)
+        if len(new) == 0:
+            return
+        new.id = np.arange(self.next_car_id, self.next_car_id + len(new))
+        self.next_car_id += len(new)
+
+        if self.engine in self.ARRAY_ENGINES:
+            self.cars.append_arrays(new)
+        else:
+            new_cars = _cars_from_arrays(new)
+            self.cars.extend(new_cars)
+            self.lane_index.add(new_cars)
 
     def _sort_cars_in_lane(self, lane_value):
-        """Sorts cars in each lane by position."""
-
-        lanes = {i: [] for i in range(1, lane_value + 1)}
-        for car in self.cars:
-            lanes[car.lane].append(car)
+        """Returns the cars in each lane sorted by position.
+
+        The lanes come from the persistent lane index, which is re-sorted once
+        per tick in _remove_exited_cars, so calling this is cheap.
+        """
+        return self.lane_index.lanes_for(lane_value)
+
+    @property
+    def spatial_index(self):
+        """CellList over the cars as they were at the start of the tick.
+
+        It is rebuilt on first use after each tick, so update methods should
+        fetch it before they start moving cars.
+        """
+        if self._spatial_index_stale:
+            if self.engine in self.ARRAY_ENGINES:
+                self._spatial_index.rebuild(self.cars.lane, self.cars.position)
+            else:
+                self._spatial_index.rebuild(
+                    [car.lane for car in self.cars], [car.position for car in self.cars]
+                )
+            self._spatial_index_stale = False
+        return self._spatial_index
 
-        for lane in lanes:
-            lanes[lane] = sorted(lanes[lane], key=lambda x: x.position)
+    def cars_near(self, lane, position, distance, lane_radius=0):
+        """Returns the cars within `distance` of `position` in lanes lane ± lane_radius.
 
-        return lanes
+        The object engine returns Car objects, the array engines return
+        indices into their car arrays.
+        """
+        indices = self.spatial_index.query(lane, position, distance, lane_radius)
+        if self.engine in self.ARRAY_ENGINES:
+            return indices
+        return [self.cars[i] for i in indices]
 
     def _calculate_statistics(self, lane_value_slider, type="none"):
         """Calculates enhanced statistics for the simulation."""
+        if self.engine in self.ARRAY_ENGINES:
+            return self._calculate_statistics_vectorized(lane_value_slider, type=type)
+
         num_cars = len(self.cars)
         avg_speed = sum(car.speed for car in self.cars) / num_cars if num_cars > 0 else 0
-        avg_density = num_cars / HIGHWAY_LENGTH
+        avg_density = num_cars / self.highway_length
         lane_distribution = [0] * lane_value_slider
 
-        speeds = []
-        times_to_exit = []
-        num_exited_cars = 0
-        slow_car_threshold = 10  # Define a threshold for slow-moving cars
-        num_slow_cars = 0
-
         for car in self.cars:
             if 1 <= car.lane <= lane_value_slider:
                 lane_distribution[car.lane - 1] += 1
-            speeds.append(car.speed)
-
-            # Track slow-moving cars
-            if car.speed < slow_car_threshold:
-                num_slow_cars += 1
-
-            # Track cars reaching destination
-            if car.position >= HIGHWAY_LENGTH:
-                num_exited_cars += 1
-                times_to_exit.append(
-                    self.time_elapsed - car.start_time
-                )  # Assuming car.start_time exists
-
-        # cars_reached_destination = []
-
-        lanes = self._sort_cars_in_lane(lane_value=lane_value_slider)
-
-        for lane in lanes:
-            for car in lanes[lane]:
-                car.time += 1
-
-                if car.position >= 90:
-                    # car reached destination
-                    self.cars_reached_destination.append(car.time)
-
-        # print(f"Cars reached destination: {self.cars_reached_destination}")
-
-        self.statistics["time_elapsed"].append(self.time_elapsed)
-        self.statistics["num_cars"].append(num_cars)
-        self.statistics["avg_speed"].append(avg_speed)
-        self.statistics["avg_density"].append(avg_density)
-        self.statistics["lane_distribution"].append(lane_distribution)
-        self.statistics["avg_num_cars_per_lane"].append(
-            np.mean(lane_distribution)
+            car.time += 1
+
+        self._record_statistics(
+            num_cars,
+            avg_speed,
+            avg_density,
+            lane_distribution,
+            sum(car.happiness for car in self.cars) / num_cars if num_cars > 0 else 0,
+            type=type,
         )
-        self.statistics['happiness_factor'].append(
-            sum(car.happiness for car in self.cars) / num_cars if num_cars > 0 else 0
+
+    def _calculate_statistics_vectorized(self, lane_value_slider, type="none"):
+        """Array version of _calculate_statistics for the vectorized engine."""
+        cars = self.cars
+        num_cars = len(cars)
+        avg_speed = cars.speed.sum() / num_cars if num_cars > 0 else 0
+        avg_density = num_cars / self.highway_length
+
+        in_range = (cars.lane >= 1) & (cars.lane <= lane_value_slider)
+        lane_distribution = np.bincount(
+            cars.lane[in_range] - 1, minlength=lane_value_slider
+        ).tolist()
+
+        cars.time += 1
+
+        self._record_statistics(
+            num_cars,
+            avg_speed,
+            avg_density,
+            lane_distribution,
+            cars.happiness.sum() / num_cars if num_cars > 0 else 0,
+            type=type,
         )
-        self.statistics["avg_time_to_exit"].append(
-            sum(self.cars_reached_destination) / len(self.cars_reached_destination) if self.cars_reached_destination else 0
+
+    def _record_statistics(
+        self, num_cars, avg_speed, avg_density, lane_distribution, happiness, type="none"
+    ):
+        """Appends one tick of statistics and hands it to the statistics sink."""
+        row = {
+            "time_elapsed": self.time_elapsed,
+            "num_cars": num_cars,
+            "avg_speed": avg_speed,
+            "avg_density": avg_density,
+            "lane_distribution": lane_distribution,
+            "avg_num_cars_per_lane": np.mean(lane_distribution),
+            "happiness_factor": happiness,
+            "avg_time_to_exit": self.cars_reached_destination.mean,
+            "num_exited": int(self.tick_exits.sum()),
+            **{
+                f"exited_{driver_type}": int(exits)
+                for driver_type, exits in zip(DRIVER_TYPES, self.tick_exits)
+            },
+        }
+        self.statistics.append(row)
+        if self.steady_state is not None:
+            self.steady_state.update(row)
+        self.profiler.mark("statistics")
+
+        if self.results_dir is None:
+            return
+
+        if type not in self.sinks:
+            self.sinks[type] = make_sink(
+                self.sink,
+                f"{self.results_dir}/statistics_{type}",
+                flush_interval=self.flush_interval,
+            )
+        self.sinks[type].write(row)
+        self.profiler.mark("sink")
+
+    def __getstate__(self):
+        # buffered statistics are written out so the sinks pickle light
+        self.flush_statistics()
+        state = self.__dict__.copy()
+        if self.rng is random:
+            state["rng"] = None  # the shared module stream stays with the process
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None:
+            self.rng = random
+
+    def set_highway_length(self, highway_length):
+        """Changes the length of the highway from the next tick on.
+
+        Cars beyond a shortened highway leave it at the end of that tick.
+        """
+        if highway_length <= 0:
+            raise ValueError(f"highway_length must be positive, got {highway_length!r}")
+        self.highway_length = highway_length
+        self._spatial_index = CellList(highway_length)
+        self._spatial_index_stale = True
+
+    def save_checkpoint(self, path):
+        """Writes the full simulation state to a binary checkpoint file.
+
+        Cars and statistics rows are stored as arrays, everything else as
+        plain values, so checkpoints are small and loading one never
+        unpickles anything. Only simulations with a named speed distribution
+        can be saved.
+        """
+        if callable(self.speed_distribution):
+            raise ValueError("Checkpoints need a named speed distribution, not a callable")
+        self.flush_statistics()
+        arrays = self.cars if self.engine in self.ARRAY_ENGINES else CarArrays.from_cars(self.cars)
+        statistics, columns = self.statistics.checkpoint_state()
+
+        # indexes are rebuilt on load, random streams are saved by their state
+        state = {
+            "settings": {name: getattr(self, name) for name in self.CHECKPOINT_SETTINGS},
+            "profile": self.profiler.enabled,
+            "time_elapsed": self.time_elapsed,
+            "next_car_id": self.next_car_id,
+            "rng": self.rng.getstate(),
+            "lattice_rng": self.lattice_rng.bit_generator.state,
+            "spawner_rng": None if self.spawner is None else self.spawner.rng.bit_generator.state,
+            "cars_reached_destination": [
+                self.cars_reached_destination.total,
+                self.cars_reached_destination.count,
+            ],
+            "tick_exits": self.tick_exits,
+            "exits_by_driver": self.exits_by_driver,
+            "statistics": statistics,
+            "sinks": {type: sink.checkpoint_state() for type, sink in self.sinks.items()},
+            "trajectory": None if self.trajectory is None else self.trajectory.checkpoint_state(),
+            "steady_state": (
+                None if self.steady_state is None else self.steady_state.checkpoint_state()
+            ),
+        }
+        write_checkpoint(path, arrays, state, columns)
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        """Returns the simulation saved by save_checkpoint, ready to continue.
+
+        The restored simulation always draws from its own random stream, set
+        to where the saved one left off, even if the saved simulation used
+        the global random module. A trajectory it was recording is cut back
+        to the checkpoint and continued.
+        """
+        arrays, state, columns = read_checkpoint(path)
+
+        settings = state["settings"]
+        # the trajectory is reopened below rather than started afresh
+        traffic_sim = cls(**{**settings, "trajectory_path": None}, profile=state["profile"])
+        if state["steady_state"] is not None:
+            traffic_sim.steady_state = SteadyStateDetector.from_checkpoint_state(
+                state["steady_state"]
+            )
+        traffic_sim.time_elapsed = state["time_elapsed"]
+        traffic_sim.next_car_id = state["next_car_id"]
+
+        version, internal_state, gauss_next = state["rng"]
+        traffic_sim.rng = random.Random()
+        traffic_sim.rng.setstate((version, tuple(internal_state), gauss_next))
+        traffic_sim.lattice_rng.bit_generator.state = state["lattice_rng"]
+        if traffic_sim.spawner is not None:
+            traffic_sim.spawner.rng.bit_generator.state = state["spawner_rng"]
+
+        total, count = state["cars_reached_destination"]
+        traffic_sim.cars_reached_destination.add_many(total, count)
+        traffic_sim.tick_exits = np.array(state["tick_exits"], dtype=np.int64)
+        traffic_sim.exits_by_driver = np.array(state["exits_by_driver"], dtype=np.int64)
+        traffic_sim.statistics = StatisticsStore.from_checkpoint_state(
+            state["statistics"], columns
         )
+        sink_class = SINKS[traffic_sim.sink]
+        traffic_sim.sinks = {
+            type: sink_class.from_checkpoint_state(sink)
+            for type, sink in state["sinks"].items()
+        }
 
-        # save the statistics to a csv file
-        with open(f"../../results/statistics_{type}.csv", "w") as f:
-            f.write("time_elapsed,num_cars,avg_speed,avg_density,lane_distribution,avg_num_cars_per_lane,happiness_factor,avg_time_to_exit\n")
-            for i in range(len(self.statistics["time_elapsed"])):
-                f.write(
-                    f"{self.statistics['time_elapsed'][i]},"
-                    f"{self.statistics['num_cars'][i]},"
-                    f"{self.statistics['avg_speed'][i]},"
-                    f"{self.statistics['avg_density'][i]},"
-                    f"{self.statistics['lane_distribution'][i]},"
-                    f"{self.statistics['avg_num_cars_per_lane'][i]},"
-                    f"{self.statistics['happiness_factor'][i]},"
-                    f"{self.statistics['avg_time_to_exit'][i]}\n"
-                )
+        traffic_sim.trajectory_path = settings["trajectory_path"]
+        if state["trajectory"] is not None:
+            traffic_sim.trajectory = TrajectoryWriter.from_checkpoint_state(state["trajectory"])
+            traffic_sim.trajectory.resume()
+
+        if traffic_sim.engine in cls.ARRAY_ENGINES:
+            traffic_sim.cars = arrays
+        else:
+            traffic_sim.cars = _cars_from_arrays(arrays)
+            traffic_sim.lane_index.rebuild(traffic_sim.cars)
+        return traffic_sim
+
+    def _record_trajectory(self, simulation_type, spawn_rate, lane_value):
+        cars = self.cars if self.engine in self.ARRAY_ENGINES else CarArrays.from_cars(self.cars)
+        statistics = {}
+        if len(self.cars):
+            statistics = {
+                "avg_speed": self.statistics.last("avg_speed"),
+                "avg_density": self.statistics.last("avg_density"),
+            }
+        self.trajectory.record(
+            self.time_elapsed,
+            cars,
+            simulation_type,
+            spawn_rate,
+            lane_value,
+            self.highway_length,
+            **statistics,
+        )
 
-    def _remove_cars(self):
-        """Removes cars that have reached the end of the highway."""
-        return [car for car in self.cars if car.position < HIGHWAY_LENGTH]
+    def flush_statistics(self):
+        """Writes every buffered statistics row and trajectory tick to disk."""
+        for sink in self.sinks.values():
+            sink.flush()
+        if self.trajectory is not None:
+            self.trajectory.flush()
+
+    def close(self):
+        """Flushes and closes the statistics sinks and the trajectory."""
+        for sink in self.sinks.values():
+            sink.close()
+        self.sinks = {}
+        if self.trajectory is not None:
+            self.trajectory.close()
+
+    def reset(self):
+        """Flushes pending statistics and starts again with an empty highway."""
+        self.close()
+        self._init_state()
+
+    def _remove_exited_cars(self):
+        """Removes the cars that reached the end of the highway and books their exits.
+
+        The exited cars are found once. Their travel times go to
+        cars_reached_destination and their driver types to tick_exits and
+        exits_by_driver before they are dropped. Array storage is compacted
+        only on ticks with exits. The object engine pops them off the lane
+        tails and compacts the car list in place, scanning only up to the
+        last exited car; cars leave in roughly spawn order, so that is a
+        short prefix.
+        """
+        if self.engine in self.ARRAY_ENGINES:
+            cars = self.cars
+            exited = cars.position >= self.highway_length
+            travel_times = cars.time[exited]
+            driver_codes = cars.driver_code[exited]
+            if len(travel_times):
+                cars.compact(~exited)
+        else:
+            self.lane_index.refresh()
+            exited = self.lane_index.remove_from(self.highway_length)
+            travel_times = [car.time for car in exited]
+            driver_codes = [car.driver_code for car in exited]
+            if exited:
+                gone = set(exited)
+                remaining = len(gone)
+                for end, car in enumerate(self.cars, 1):
+                    if car in gone:
+                        remaining -= 1
+                        if not remaining:
+                            break
+                self.cars[:end] = [car for car in self.cars[:end] if car not in gone]
+
+        self.tick_exits = np.bincount(driver_codes, minlength=len(DRIVER_TYPES))
+        self.exits_by_driver += self.tick_exits
+        self.cars_reached_destination.add_many(int(np.sum(travel_times)), len(travel_times))
 
     def _apres_simulation(self, spawn_rate, lane_value, type="none"):
+        tick = self.time_elapsed
+        self.profiler.mark("movement")
+
         # Remove cars that have reached the end of the highway
-        self.cars = self._remove_cars()
+        self._remove_exited_cars()
+        self.profiler.mark("removal")
 
         # Add new cars
         self._add_car(spawn_rate, lane_value)
+        self._spatial_index_stale = True
+        self.profiler.mark("spawn")
 
         # Update statistics
-        if self.cars:
+        if len(self.cars):
             self._calculate_statistics(lane_value_slider=lane_value, type=type)
 
+        if self.trajectory is not None:
+            self._record_trajectory(type, spawn_rate, lane_value)
+            self.profiler.mark("trajectory")
+
         self.time_elapsed += 1
+
+        if self.autosave_path and self.time_elapsed % self.autosave_interval == 0:
+            self.save_checkpoint(self.autosave_path)
+            self.profiler.mark("checkpoint")
+
+        self.profiler.end(tick)
         return self.cars
 
+    def update(self, simulation_type, spawn_rate, lane_value):
+        """Advances the simulation one time step with the given driver model."""
+        if simulation_type not in self.SIMULATION_TYPES:
+            raise ValueError(
+                f"Unknown simulation type {simulation_type!r}, expected one of {self.SIMULATION_TYPES}"
+            )
+        return getattr(self, f"update_{simulation_type}")(spawn_rate, lane_value)
+
     def update_simple(self, spawn_rate, lane_value):
         """Updates the entire simulation for one time step."""
+        self.profiler.begin(self.time_elapsed)
+        if self.engine == "jit":
+            step_simple_jit(self.cars)
+            return self._apres_simulation(spawn_rate, lane_value, type="simple")
+        if self.engine == "vectorized":
+            step_simple(self.cars)
+            return self._apres_simulation(spawn_rate, lane_value, type="simple")
+
         # Organize cars by lane
         lanes = self._sort_cars_in_lane(lane_value=lane_value)
 
@@ -222,8 +790,21 @@ class HighwayTrafficSimulation:
         return self._apres_simulation(spawn_rate, lane_value, type="simple")
 
     def update_individualistic(self, spawn_rate, lane_value):
+        self.profiler.begin(self.time_elapsed)
+        if self.engine in self.ARRAY_ENGINES:
+            step_individualistic(self.cars, lane_value)
+            return self._apres_simulation(spawn_rate, lane_value, type="individualistic")
+
         # Organize cars by lane
         lanes = self._sort_cars_in_lane(lane_value=lane_value)
+        changed_lanes = []
+
+        # Sorted positions of every lane for the "cars ahead" search. Lanes are
+        # processed in ascending order, so a lane's entry is refreshed once all
+        # of its cars have moved; the lanes above still hold their old positions.
+        lane_positions = {
+            lane: [car.position for car in lanes[lane]] for lane in lanes
+        }
 
         for lane in lanes:
             if len(lanes[lane]) > 1:
@@ -254,36 +835,38 @@ class HighwayTrafficSimulation:
 
                         num_cars_in_lanes = {}
 
-                        rear_car_safe_distance = [rear_car.safe_distance - rear_car.position, rear_car.safe_distance + rear_car.position]
-
                         # check if the neighboring lanes would allow the rear car to move
                         for neighboring_lane in neighboring_lanes:
+                            positions = lane_positions[neighboring_lane]
 
                             # no cars in the neighboring lane
-                            if len(lanes[neighboring_lane]) == 0:
+                            if not positions:
                                 best_lane = neighboring_lane
                                 break
 
-                            # there are some cars in the neighboring lane
-                            else:
-
-                                # check to see if there are any cars in the neighboring lane that would collide with the rear car
-                                for car in lanes[neighboring_lane]:
+                            # skip the lane if one of its cars is within the rear car's
+                            # safe distance of where the rear car will be
+                            if bisect_left(
+                                positions, rear_car_position_next_step - rear_car.safe_distance
+                            ) < bisect_right(
+                                positions, rear_car_position_next_step + rear_car.safe_distance
+                            ):
+                                continue
 
-                                    # if the car in the neighboring lane would collide with the rear car
-                                    if car.position + car.speed >= rear_car_position_next_step - rear_car_safe_distance[0] and car.position - car.speed <= rear_car_position_next_step + rear_car_safe_distance[1]:
-                                        break
-
-                                # if the car in the neighboring lane would not collide with the rear car
-                                # obtain the number of cars in the neighboring lane ahead of the rear car
-                                # get the number of cars in the neighboring lane ahead of the rear car
-                                num_cars_in_lanes[neighboring_lane] = len([x for x in lanes[neighboring_lane] if x.position > rear_car.position])
+                            # there are some cars in the neighboring lane
+                            # get the number of cars in the neighboring lane ahead of the rear car
+                            num_cars_in_lanes[neighboring_lane] = len(positions) - bisect_right(
+                                positions, rear_car.position
+                            )
 
                         # find the lane with the least number of cars ahead of the rear car
                         if num_cars_in_lanes:
                             best_lane = min(num_cars_in_lanes, key=num_cars_in_lanes.get)
 
-                        rear_car.lane = best_lane
+                        # stay in the current lane when no neighbouring lane has a gap
+                        if best_lane is not None:
+                            rear_car.lane = best_lane
+                            changed_lanes.append(rear_car)
                         rear_car.position = rear_car_position + rear_car.speed
 
                         rear_car.happiness -= 2
@@ -299,11 +882,24 @@ class HighwayTrafficSimulation:
                 car = lanes[lane][0]
                 car.position += car.speed
 
+            lane_positions[lane] = sorted(car.position for car in lanes[lane])
+
+        self.lane_index.change_lanes(changed_lanes)
+
         return self._apres_simulation(spawn_rate, lane_value, type="individualistic")
 
     def update_penguin(self, spawn_rate, lane_value):
+        self.profiler.begin(self.time_elapsed)
 
         huddle_distance = 1
+        self._join_neighbour_huddles()
+        if self.engine == "jit":
+            step_penguin_jit(self.cars, huddle_distance=huddle_distance)
+            return self._apres_simulation(spawn_rate, lane_value, type="penguin")
+        if self.engine == "vectorized":
+            step_penguin(self.cars, huddle_distance=huddle_distance)
+            return self._apres_simulation(spawn_rate, lane_value, type="penguin")
+
         lanes = self._sort_cars_in_lane(lane_value=lane_value)
 
         for lane in lanes:
@@ -357,3 +953,86 @@ class HighwayTrafficSimulation:
                 car.position += car.speed
 
         return self._apres_simulation(spawn_rate, lane_value, type="penguin")
+
+    def _join_neighbour_huddles(self):
+        """Lets cars join the huddles in the lanes next to them, see
+        huddle_joiners. Every car decides on the huddles as they were at the
+        start of the tick."""
+        cars = self.cars
+        if self.engine in self.ARRAY_ENGINES:
+            if cars.is_in_huddle.any():
+                index = self.spatial_index
+                cars.is_in_huddle |= huddle_joiners(
+                    index, index.lanes, index.positions, cars.safe_distance, cars.is_in_huddle
+                )
+            return
+
+        if not any(car.is_in_huddle for car in cars):
+            return
+        index = self.spatial_index
+        joins = huddle_joiners(
+            index,
+            index.lanes,
+            index.positions,
+            np.array([car.safe_distance for car in cars], dtype=np.float64),
+            np.array([car.is_in_huddle for car in cars], dtype=np.bool_),
+        )
+        for car in itertools.compress(cars, joins):
+            car.is_in_huddle = True
+
+    def _update_lattice(self, spawn_rate, lane_value, simulation_type):
+        """Advances the cars one step of the lattice cellular automaton."""
+        self.profiler.begin(self.time_elapsed)
+
+        variant = self.LATTICE_VARIANTS[simulation_type]
+        if self.engine in self.ARRAY_ENGINES:
+            step_lattice(
+                self.cars,
+                lane_value,
+                self.highway_length,
+                self.lattice_rng,
+                variant=variant,
+                slowdown_probability=self.slowdown_probability,
+            )
+            return self._apres_simulation(spawn_rate, lane_value, type=simulation_type)
+
+        # the automaton runs on arrays; the cars take over the result
+        arrays = CarArrays.from_cars(self.cars)
+        step_lattice(
+            arrays,
+            lane_value,
+            self.highway_length,
+            self.lattice_rng,
+            variant=variant,
+            slowdown_probability=self.slowdown_probability,
+        )
+        changed_lanes = []
+        for car, lane, position, speed, happiness, time_in_huddle, is_in_huddle in zip(
+            self.cars,
+            arrays.lane.tolist(),
+            arrays.position.tolist(),
+            arrays.speed.tolist(),
+            arrays.happiness.tolist(),
+            arrays.time_in_huddle.tolist(),
+            arrays.is_in_huddle.tolist(),
+        ):
+            if car.lane != lane:
+                car.lane = lane
+                changed_lanes.append(car)
+            car.position = position
+            car.speed = speed
+            car.happiness = happiness
+            car.time_in_huddle = time_in_huddle
+            car.is_in_huddle = is_in_huddle
+        self.lane_index.change_lanes(changed_lanes)
+
+        return self._apres_simulation(spawn_rate, lane_value, type=simulation_type)
+
+    def update_lattice(self, spawn_rate, lane_value):
+        return self._update_lattice(spawn_rate, lane_value, "lattice")
+
+    def update_lattice_penguin(self, spawn_rate, lane_value):
+        return self._update_lattice(spawn_rate, lane_value, "lattice_penguin")
+
+    def update_lattice_lanes(self, spawn_rate, lane_value):
+        return self._update_lattice(spawn_rate, lane_value, "lattice_lanes")
@@ -0,0 +1,148 @@
+# In[1]:
+# jit_kernels.py
+import numpy as np
+
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:  # the kernels run as plain Python without numba
+    NUMBA_AVAILABLE = False
+
+# In[2]: Kernels
+# The kernels walk the cars sorted by lane and position, exactly like the
+# per-lane loops of HighwayTrafficSimulation, and read every leader's state
+# from before the step. They only use scalar arithmetic so numba can compile
+# them; without numba the same functions run as ordinary Python.
+def simple_kernel(order, lane, position, speed, safe_distance, happiness):
+    new_position = position + speed
+    new_speed = speed.copy()
+
+    for k in range(order.shape[0] - 1):
+        rear = order[k]
+        front = order[k + 1]
+        if lane[rear] != lane[front]:
+            continue
+
+        # Check if the rear car will collide with the front car
+        if position[rear] + speed[rear] >= (
+            position[front] + speed[front] - safe_distance[rear]
+        ):
+            new_speed[rear] = min(speed[front], speed[rear])
+            new_position[rear] = position[front] - safe_distance[rear]
+            happiness[rear] -= 3
+
+    return new_position, new_speed
+
+
+def penguin_kernel(
+    order,
+    lane,
+    position,
+    speed,
+    safe_distance,
+    happiness,
+    time_in_huddle,
+    is_in_huddle,
+    huddle_distance,
+):
+    new_position = position + speed
+    new_speed = speed.copy()
+
+    for k in range(order.shape[0] - 1):
+        rear = order[k]
+        front = order[k + 1]
+        if lane[rear] != lane[front]:
+            continue
+
+        # rear car is in a huddle, increment the time in huddle
+        if is_in_huddle[rear]:
+            time_in_huddle[rear] += 1
+
+        # rear car has been in the huddle for 3 steps, it adopts the huddle mindset
+        if time_in_huddle[rear] >= 3:
+            new_speed[rear] = min(speed[front], speed[rear])
+            new_position[rear] = position[front] + speed[front] - huddle_distance
+
+        # Check if the rear car will collide with the front car
+        elif position[rear] + speed[rear] >= (
+            position[front] + speed[front] - safe_distance[rear]
+        ):
+            new_speed[rear] = min(speed[front], speed[rear])
+            new_position[rear] = position[front] - safe_distance[rear]
+            is_in_huddle[rear] = True
+            happiness[rear] -= 1
+
+    return new_position, new_speed
+
+
+if NUMBA_AVAILABLE:
+    compiled_simple_kernel = njit(cache=True)(simple_kernel)
+    compiled_penguin_kernel = njit(cache=True)(penguin_kernel)
+else:
+    compiled_simple_kernel = simple_kernel
+    compiled_penguin_kernel = penguin_kernel
+
+
+# In[3]: Steps over CarArrays
+def step_simple_jit(arrays, compiled=True):
+    """Kernel equivalent of HighwayTrafficSimulation.update_simple."""
+    kernel = compiled_simple_kernel if compiled else simple_kernel
+    arrays.position, arrays.speed = kernel(
+        arrays.lane_order(),
+        arrays.lane,
+        arrays.position,
+        arrays.speed,
+        arrays.safe_distance,
+        arrays.happiness,
+    )
+
+
+def step_penguin_jit(arrays, huddle_distance=1, compiled=True):
+    """Kernel equivalent of HighwayTrafficSimulation.update_penguin."""
+    kernel = compiled_penguin_kernel if compiled else penguin_kernel
+    arrays.position, arrays.speed = kernel(
+        arrays.lane_order(),
+        arrays.lane,
+        arrays.position,
+        arrays.speed,
+        arrays.safe_distance,
+        arrays.happiness,
+        arrays.time_in_huddle,
+        arrays.is_in_huddle,
+        float(huddle_distance),
+    )
+
+
+# In[4]: Parity check
+def check_parity(num_cars=2000, lanes=5, steps=100, seed=0):
+    """Steps the same random highway with the compiled and the plain Python
+    kernels and raises AssertionError if their trajectories ever differ."""
+    from app.utils.vectorized_engine import CarArrays
+
+    rng = np.random.default_rng(seed)
+    for step in (step_simple_jit, step_penguin_jit):
+        start = CarArrays()
+        start.lane = rng.integers(1, lanes + 1, num_cars)
+        start.position = rng.integers(0, 100, num_cars).astype(np.float64)
+        start.speed = rng.integers(2, 11, num_cars).astype(np.float64)
+        start.safe_distance = rng.choice([1.0, 2.0, 3.0], num_cars)
+        start.happiness = np.full(num_cars, 10.0)
+        start.time_in_huddle = np.zeros(num_cars, dtype=np.int64)
+        start.is_in_huddle = np.zeros(num_cars, dtype=np.bool_)
+
+        compiled, python = start.copy(), start.copy()
+        for tick in range(steps):
+            step(compiled, compiled=True)
+            step(python, compiled=False)
+            for name in ("position", "speed", "happiness", "time_in_huddle", "is_in_huddle"):
+                if not np.array_equal(getattr(compiled, name), getattr(python, name)):
+                    raise AssertionError(
+                        f"{step.__name__}: {name} differs at tick {tick}"
+                    )
+    return True
+
+
+if __name__ == "__main__":
+    check_parity()
+    print(f"Kernels agree (numba {'enabled' if NUMBA_AVAILABLE else 'not installed'})")
@@ -0,0 +1,115 @@
+# In[1]:
+# lane_index.py
+from bisect import insort
+
+# In[2]:
+class LaneIndex:
+    """Keeps the cars of every lane ordered by position between ticks.
+
+    Cars only move a few units per tick, so the lanes stay nearly sorted and
+    re-sorting them in place (Timsort) costs close to O(n) instead of the
+    O(n log n) of rebuilding every lane from scratch. Ties are broken by spawn
+    order, which is the order of HighwayTrafficSimulation.cars.
+    """
+
+    def __init__(self):
+        self.lanes = {}
+        self._spawn_order = {}
+        self._next_order = 0
+        # (lane, index) of every car, rebuilt on the first leader/follower
+        # lookup after the lanes changed
+        self._slots = None
+
+    def _key(self, car):
+        return (car.position, self._spawn_order[car])
+
+    def lanes_for(self, lane_value):
+        """Returns the ordered cars of every lane, keyed by lane in ascending order.
+
+        Lanes 1..lane_value are always included. Lanes above it still hold
+        the cars that were on them when the number of lanes went down;
+        those keep driving until they leave the highway, as they do in the
+        array engines.
+        """
+        for lane in range(1, lane_value + 1):
+            self.lanes.setdefault(lane, [])
+        return {lane: self.lanes[lane] for lane in sorted(self.lanes)}
+
+    def rebuild(self, cars):
+        """Rebuilds the index from cars given in spawn order."""
+        self.lanes = {}
+        self._spawn_order = {}
+        self._next_order = 0
+        self._slots = None
+        for car in cars:
+            self._spawn_order[car] = self._next_order
+            self._next_order += 1
+            self.lanes.setdefault(car.lane, []).append(car)
+        self.refresh()
+
+    def add(self, cars):
+        """Inserts newly spawned cars at their position in their lane."""
+        for car in cars:
+            self._spawn_order[car] = self._next_order
+            self._next_order += 1
+            insort(self.lanes.setdefault(car.lane, []), car, key=self._key)
+        self._slots = None
+
+    def change_lanes(self, cars):
+        """Moves cars whose `lane` attribute changed into their new lane."""
+        if not cars:
+            return
+        moved = set(cars)
+        for lane in self.lanes:
+            if any(car in moved for car in self.lanes[lane]):
+                self.lanes[lane] = [car for car in self.lanes[lane] if car not in moved]
+        for car in cars:
+            self.lanes.setdefault(car.lane, []).append(car)
+        self._slots = None
+
+    def refresh(self):
+        """Restores the position order of every lane after cars have moved."""
+        for cars in self.lanes.values():
+            cars.sort(key=self._key)
+        self._slots = None
+
+    def remove_from(self, highway_length):
+        """Drops the cars that reached `highway_length` from the lane tails
+        and returns them."""
+        removed = []
+        for cars in self.lanes.values():
+            while cars and cars[-1].position >= highway_length:
+                car = cars.pop()
+                del self._spawn_order[car]
+                removed.append(car)
+        if removed:
+            self._slots = None
+        return removed
+
+    def __iter__(self):
+        for lane in sorted(self.lanes):
+            yield from self.lanes[lane]
+
+    def _slot(self, car):
+        if self._slots is None:
+            self._slots = {
+                other: (lane, i)
+                for lane, cars in self.lanes.items()
+                for i, other in enumerate(cars)
+            }
+        return self._slots[car]
+
+    def leader(self, car):
+        """Returns the car directly ahead of `car` in its lane, or None.
+
+        Like every lookup here it reflects the order of the last refresh,
+        so during a tick it answers for the positions the tick started from.
+        """
+        lane, i = self._slot(car)
+        cars = self.lanes[lane]
+        return cars[i + 1] if i + 1 < len(cars) else None
+
+    def follower(self, car):
+        """Returns the car directly behind `car` in its lane, or None."""
+        lane, i = self._slot(car)
+        return self.lanes[lane][i - 1] if i > 0 else None
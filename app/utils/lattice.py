@@ -0,0 +1,200 @@
+# In[1]:
+# lattice.py
+import numpy as np
+
+LATTICE_VARIANTS = ("plain", "penguin", "lane_change")
+SLOWDOWN_PROBABILITY = 0.2  # chance a car dawdles one cell per step
+HUDDLE_TIME = 3  # steps in a huddle before a car follows its leader closely
+DENSE_CELLS = 1 << 16  # lattices up to this many cells also keep a dense grid
+
+# In[2]: Occupancy
+class Occupancy:
+    """The occupied cells of the lattice, looked up by binary search.
+
+    Every car sits in cell `cell` of row `lane`. The occupied cells are kept
+    as sorted keys lane * cells + cell together with the car in each, so
+    memory and build time grow with the number of cars and every lookup
+    costs O(log n), however long the road. Rows are lanes; row 0 is never
+    occupied. Lattices of up to DENSE_CELLS cells also keep a dense grid of
+    the car in every cell, which makes car_at a plain lookup.
+
+    Cars can share a cell when new cars enter behind a queue reaching the
+    start of the road. The cell then holds the car stored first, the one
+    that has been on the road longest, and the others are `queued`.
+    """
+
+    def __init__(self, lane, cell, cells):
+        self.cells = cells
+        # cells without a car ahead or behind get one this far away, so gaps
+        # to them never limit a car
+        self.far = 2 * cells + 1_000_000
+
+        keys = lane * cells + cell
+        # the stable sort keeps storage order within a cell, so the first car
+        # of every run of equal keys is the one the cell holds
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        first = np.ones(len(keys), dtype=np.bool_)
+        first[1:] = keys[1:] != keys[:-1]
+        self.keys = keys[first]
+        self.car = order[first]
+        self.queued = np.ones(len(order), dtype=np.bool_)
+        self.queued[self.car] = False
+
+        # small lattices also index the cars by cell directly, one spare row
+        # above the highest lane so lane + 1 is always a row
+        self.grid = None
+        size = (int(self.keys[-1]) // cells + 2) * cells if len(self.keys) else 0
+        if size <= DENSE_CELLS:
+            self.grid = np.full(size, -1, dtype=np.int64)
+            self.grid[self.keys] = self.car
+
+    def car_at(self, lane, cell):
+        """Returns the car in every given cell, -1 for empty cells."""
+        query = lane * self.cells + cell
+        if self.grid is not None:
+            return self.grid[query]
+        found = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        return np.where(self.keys[found] == query, self.car[found], -1)
+
+    def ahead(self, lane, cell):
+        """Returns the nearest occupied cell strictly ahead of every given
+        cell in its lane."""
+        found = np.searchsorted(self.keys, lane * self.cells + cell, side="right")
+        nearest = self.keys[np.minimum(found, len(self.keys) - 1)]
+        in_lane = (found < len(self.keys)) & (nearest // self.cells == lane)
+        return np.where(in_lane, nearest - lane * self.cells, self.far)
+
+    def behind(self, lane, cell):
+        """Returns the nearest occupied cell strictly behind every given cell
+        in its lane."""
+        found = np.searchsorted(self.keys, lane * self.cells + cell, side="left") - 1
+        nearest = self.keys[np.maximum(found, 0)]
+        in_lane = (found >= 0) & (nearest // self.cells == lane)
+        return np.where(in_lane, nearest - lane * self.cells, -self.far)
+
+
+# In[3]: Rules
+def _change_lanes(arrays, cell, speed, lane_value, lane_offset, rows, cells):
+    """Symmetric lane changes, first towards the lower lane, then the upper.
+
+    A car moves sideways into the free cell next to it when the car ahead
+    would slow it down, the target lane leaves it a longer gap, and the
+    nearest car behind in the target lane cannot reach its cell next step.
+    Each direction is a separate sub-step on a fresh Occupancy, so two cars
+    never change into the same cell. Returns the cars that changed lanes.
+    """
+    changed = np.zeros(len(cell), dtype=np.bool_)
+    for direction in (-1, 1):
+        lane = arrays.lane
+        occupancy = Occupancy(lane, cell, cells)
+
+        target = lane + direction
+        local = target - lane_offset
+        # a car queued behind another in the same cell waits for it to leave
+        allowed = (local >= 1) & (local <= lane_value) & ~changed & ~occupancy.queued
+        target = np.clip(target, 0, rows - 1)
+
+        gap = occupancy.ahead(lane, cell) - cell - 1
+        target_gap = occupancy.ahead(target, cell) - cell - 1
+        follower_cell = occupancy.behind(target, cell)
+        has_follower = follower_cell >= 0
+        follower = np.where(
+            has_follower, occupancy.car_at(target, np.maximum(follower_cell, 0)), 0
+        )
+        follower_reach = np.where(has_follower, speed[follower] + 1, 0)
+
+        moves = (
+            allowed
+            & (occupancy.car_at(target, cell) < 0)
+            & (gap < speed + 1)
+            & (target_gap > gap)
+            & (cell - follower_cell - 1 >= follower_reach)
+        )
+        arrays.lane = np.where(moves, target, lane)
+        changed |= moves
+    return changed
+
+
+def step_lattice(
+    arrays,
+    lane_value,
+    highway_length,
+    rng,
+    variant="plain",
+    slowdown_probability=SLOWDOWN_PROBABILITY,
+    lane_offset=0,
+):
+    """Advances CarArrays one step of a Nagel-Schreckenberg cellular automaton.
+
+    The road is a lattice of one-unit cells per lane, and every car sits in
+    the cell under its position. Each car moves at a whole number of cells
+    per step, with all cars updated in parallel:
+    1. It accelerates by one, up to its ideal speed.
+    2. It brakes to the number of free cells ahead.
+    3. With `slowdown_probability` it dawdles one cell slower.
+    4. It moves forward.
+
+    Cars that have to brake for the car ahead lose happiness, as in the agent
+    based models. The "penguin" variant lets cars that stayed in a huddle for
+    HUDDLE_TIME steps close up on their leader. They count on the least
+    the leader can move and never dawdle, so the huddle moves as a block.
+    The "lane_change" variant first lets slowed-down cars change to a
+    neighbouring lane, see _change_lanes. `lane_offset` numbers several
+    highways in one array like step_individualistic does.
+    """
+    if variant not in LATTICE_VARIANTS:
+        raise ValueError(f"Unknown lattice variant {variant!r}, expected one of {LATTICE_VARIANTS}")
+    num_cars = len(arrays)
+    if num_cars == 0:
+        return
+
+    cells = max(int(np.ceil(highway_length)), 1)
+    cell = np.clip(np.floor(arrays.position).astype(np.int64), 0, cells - 1)
+    speed = np.floor(arrays.speed).astype(np.int64)
+    max_speed = np.floor(arrays.ideal_speed).astype(np.int64)
+    # one spare row above the highest lane, so lane + 1 is always a row
+    rows = int(arrays.lane.max()) + 2
+
+    if variant == "lane_change":
+        _change_lanes(arrays, cell, speed, lane_value, lane_offset, rows, cells)
+
+    lane = arrays.lane
+    occupancy = Occupancy(lane, cell, cells)
+    leader_cell = occupancy.ahead(lane, cell)
+    gap = leader_cell - cell - 1
+    # cars queued in the cell of another car stay put until it has left
+    queued = occupancy.queued
+    gap[queued] = 0
+
+    desired = np.minimum(speed + 1, max_speed)
+    if variant == "penguin":
+        arrays.time_in_huddle[arrays.is_in_huddle] += 1
+        huddled = arrays.time_in_huddle >= HUDDLE_TIME
+
+        # the least the leader moves: braked to its own gap, then dawdling
+        has_leader = (leader_cell < cells) & ~queued
+        leader = occupancy.car_at(lane, np.minimum(leader_cell, cells - 1))
+        leader_gap = occupancy.ahead(lane[leader], cell[leader]) - cell[leader] - 1
+        leader_moves = np.maximum(
+            np.minimum(np.minimum(speed[leader] + 1, max_speed[leader]), leader_gap) - 1, 0
+        )
+        gap = np.where(huddled & has_leader, gap + leader_moves, gap)
+    else:
+        huddled = np.zeros(num_cars, dtype=np.bool_)
+
+    new_speed = np.minimum(desired, gap)
+    blocked = new_speed < desired
+    dawdles = (rng.random(num_cars) < slowdown_probability) & ~huddled
+    new_speed = np.where(dawdles, np.maximum(new_speed - 1, 0), new_speed)
+
+    if variant == "penguin":
+        arrays.is_in_huddle[blocked] = True
+        arrays.happiness[blocked & ~huddled] -= 1
+    elif variant == "lane_change":
+        arrays.happiness[blocked] -= 2
+    else:
+        arrays.happiness[blocked] -= 3
+
+    arrays.position = (cell + new_speed).astype(np.float64)
+    arrays.speed = new_speed.astype(np.float64)
@@ -0,0 +1,126 @@
+# In[1]:
+# profiling.py
+import cProfile
+import os
+import time
+from collections import deque
+
+import numpy as np
+
+# In[2]:
+class PhaseTimer:
+    """Times the phases of every simulation tick and keeps rolling percentiles.
+
+    A tick is bracketed by begin() and end(); in between, mark(name) books
+    the time since the previous mark (or begin) under phase `name`, and
+    phase(name) times a block of code outside the tick, such as drawing a
+    figure. The last `window` durations of every phase are kept.
+
+    While disabled every call returns after an attribute check or two, so
+    the hooks can stay in the simulation loop. A cProfile window can be armed
+    independently of the timings with profile_ticks().
+    """
+
+    def __init__(self, enabled=False, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.durations = {}
+        self._last = None
+        self._tick_started = None
+        self._profile = None
+        self._profile_window = None  # (first tick, last tick, path)
+
+    def _book(self, name, seconds):
+        durations = self.durations.get(name)
+        if durations is None:
+            durations = self.durations[name] = deque(maxlen=self.window)
+        durations.append(seconds)
+
+    def begin(self, tick):
+        """Starts timing a tick."""
+        window = self._profile_window
+        if window is not None and self._profile is None and tick >= window[0]:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        if not self.enabled:
+            return
+        self._tick_started = self._last = time.perf_counter()
+
+    def mark(self, name):
+        """Books the time since the previous mark under phase `name`."""
+        if not self.enabled or self._last is None:
+            return
+        now = time.perf_counter()
+        self._book(name, now - self._last)
+        self._last = now
+
+    def end(self, tick):
+        """Ends the tick, booking its total duration under "tick"."""
+        if self._profile is not None and tick >= self._profile_window[1]:
+            self._profile.disable()
+            path = self._profile_window[2]
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._profile.dump_stats(path)
+            self._profile = None
+            self._profile_window = None
+        if not self.enabled or self._tick_started is None:
+            return
+        self._book("tick", time.perf_counter() - self._tick_started)
+        self._tick_started = self._last = None
+
+    def phase(self, name):
+        """Returns a context manager timing its block under phase `name`."""
+        return _Phase(self, name) if self.enabled else _NO_PHASE
+
+    def profile_ticks(self, first, last, path):
+        """Runs cProfile from the start of tick `first` to the end of tick
+        `last` and dumps the pstats file to `path`."""
+        self._profile_window = (first, last, path)
+
+    def reset(self):
+        """Forgets every recorded duration."""
+        self.durations = {}
+
+    def summary(self, percentiles=(50, 90, 99)):
+        """Returns {phase: {"count", "mean_ms", "p50_ms", ...}} over the window."""
+        summary = {}
+        for name, durations in list(self.durations.items()):
+            if not durations:
+                continue
+            milliseconds = np.fromiter(durations, dtype=np.float64) * 1e3
+            row = {"count": len(milliseconds), "mean_ms": float(milliseconds.mean())}
+            for q, value in zip(percentiles, np.percentile(milliseconds, percentiles)):
+                row[f"p{q}_ms"] = float(value)
+            summary[name] = row
+        return summary
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_profile"] = None  # a running profile stays with the process
+        return state
+
+
+class _Phase:
+    __slots__ = ("timer", "name", "started")
+
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer._book(self.name, time.perf_counter() - self.started)
+
+
+class _NoPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return None
+
+
+_NO_PHASE = _NoPhase()
@@ -0,0 +1,371 @@
+# In[1]:
+# session_manager.py
+import os
+import pickle
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # no advisory file locks, the store cannot guard itself
+    fcntl = None
+
+from app.utils.simulation_worker import SimulationWorker
+from app.utils.vectorized_engine import CarArrays
+
+# rough size of one slotted Car with its float attributes and lane index entries
+OBJECT_CAR_BYTES = 400
+
+# In[2]: Session stores
+def is_session_id(session_id):
+    """True for the uuid4 hex strings the app hands out as session ids.
+
+    Session ids come from the browser, so they are checked before they are
+    used in file names or store keys.
+    """
+    if not isinstance(session_id, str) or len(session_id) != 32:
+        return False
+    try:
+        parsed = uuid.UUID(hex=session_id)
+    except ValueError:
+        return False
+    return parsed.version == 4 and parsed.hex == session_id
+
+
+def check_session_id(session_id):
+    if not is_session_id(session_id):
+        raise ValueError(f"Invalid session id {session_id!r}")
+
+
+class FileSessionStore:
+    """Keeps serialized sessions as files in a directory.
+
+    Sessions saved more than `ttl` seconds ago are deleted by expire(); None
+    keeps them until they are restored.
+
+    The directory belongs to one process at a time, see SessionManager. The
+    store locks it on first use until close() or the end of the process,
+    and raises RuntimeError if another process holds it already. A process
+    that never touches the store, such as the reloader of a debug server,
+    does not lock it.
+    """
+
+    def __init__(self, directory, ttl=None):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self._lock_file = None
+
+    def _claim(self):
+        if fcntl is None or self._lock_file is not None:
+            return
+        lock_file = open(os.path.join(self.directory, ".lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            raise RuntimeError(
+                f"{self.directory} is used by another process. Sessions are served "
+                f"by a single process; run one worker with several threads"
+            ) from None
+        self._lock_file = lock_file
+
+    def close(self):
+        """Releases the directory for other processes."""
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def _path(self, session_id):
+        check_session_id(session_id)
+        self._claim()
+        return os.path.join(self.directory, f"{session_id}.pkl")
+
+    def save(self, session_id, data):
+        path = self._path(session_id)
+        # write to a temporary file first so readers never see half a session
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def load(self, session_id):
+        try:
+            with open(self._path(session_id), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, session_id):
+        try:
+            os.remove(self._path(session_id))
+        except FileNotFoundError:
+            pass
+
+    def expire(self):
+        """Deletes the sessions saved more than `ttl` seconds ago and returns their ids."""
+        if self.ttl is None:
+            return []
+        self._claim()
+        cutoff = time.time() - self.ttl
+        expired = []
+        for name in os.listdir(self.directory):
+            session_id, extension = os.path.splitext(name)
+            if extension != ".pkl" or not is_session_id(session_id):
+                continue
+            try:
+                if os.path.getmtime(os.path.join(self.directory, name)) < cutoff:
+                    os.remove(os.path.join(self.directory, name))
+                    expired.append(session_id)
+            except FileNotFoundError:
+                pass  # restored or expired by another process meanwhile
+        return expired
+
+
+class RedisSessionStore:
+    """Keeps serialized sessions in a Redis-compatible key-value server.
+
+    `client` is any object with get/set/delete, such as a redis.Redis
+    connection or a local stand-in implementing the same three methods.
+    Unlike FileSessionStore it cannot tell whether another process uses the
+    same prefix, so give every serving process its own.
+    """
+
+    def __init__(self, client, prefix="penguin-traffic:session:", ttl=None):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def save(self, session_id, data):
+        if self.ttl is None:
+            self.client.set(self.prefix + session_id, data)
+        else:
+            self.client.set(self.prefix + session_id, data, ex=self.ttl)
+
+    def load(self, session_id):
+        return self.client.get(self.prefix + session_id)
+
+    def delete(self, session_id):
+        self.client.delete(self.prefix + session_id)
+
+    def expire(self):
+        """Sessions expire on the server through their `ttl`, so there is
+        nothing to do and no ids to return."""
+        return []
+
+    def close(self):
+        pass
+
+
+# In[3]: Session manager
+def estimate_memory(traffic_sim):
+    """Approximates the bytes held by a simulation's cars and statistics."""
+    cars = traffic_sim.cars
+    if isinstance(cars, CarArrays):
+        car_bytes = sum(getattr(cars, name).nbytes for name in CarArrays.FIELDS)
+    else:
+        car_bytes = len(cars) * OBJECT_CAR_BYTES
+
+    stats = traffic_sim.statistics
+    buffers = [stats.recent] + ([stats.history] if stats.history is not None else [])
+    stats_bytes = sum(
+        column.nbytes for buffer in buffers for column in buffer.columns.values()
+    )
+    return car_bytes + stats_bytes
+
+
+class SessionManager:
+    """Holds one SimulationWorker per browser session, least recently used first.
+
+    Sessions idle for longer than `idle_timeout` seconds, sessions beyond
+    `max_sessions` and, oldest first, sessions pushing the estimated total
+    memory past `memory_limit` bytes are evicted. With a `store`, an evicted
+    session is serialized there and restored on its next request, which
+    takes it out of the store again. Every `expire_interval` seconds the
+    manager asks the store to drop the sessions it has kept for too long and
+    calls `on_expire` with the id of each, to clean up what they left on
+    disk. The store keeps sessions across evictions and restarts.
+
+    Every session runs on a worker thread in the process that holds it, so
+    all requests must reach that one process. Serve the app from a single
+    process with several threads; FileSessionStore refuses a second process.
+
+    Evicted sessions are stopped and serialized, and stored sessions read
+    and unpickled, after the manager's lock is released, so a slow save or
+    restore holds up only requests for that session.
+    """
+
+    def __init__(
+        self,
+        factory,
+        max_sessions=32,
+        idle_timeout=15 * 60,
+        memory_limit=512 * 2**20,
+        store=None,
+        expire_interval=60 * 60,
+        on_expire=None,
+    ):
+        self.factory = factory
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.memory_limit = memory_limit
+        self.store = store
+        self.expire_interval = expire_interval
+        self.on_expire = on_expire
+
+        self._sessions = OrderedDict()  # session id -> (worker, last access)
+        # session id -> Event set once the session is stored or restored
+        self._pending = {}
+        self._last_expiry = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __contains__(self, session_id):
+        return session_id in self._sessions
+
+    def get(self, session_id):
+        """Returns the worker of a session, restoring or creating it if needed.
+
+        Raises ValueError for anything but a uuid4 hex session id.
+        """
+        check_session_id(session_id)
+        while True:
+            with self._lock:
+                pending = self._pending.get(session_id)
+                if pending is None:
+                    if session_id in self._sessions:
+                        worker, _ = self._sessions.pop(session_id)
+                        self._sessions[session_id] = (worker, time.monotonic())
+                        evicted = self._evict(keep=session_id)
+                        break
+                    pending = self._pending[session_id] = threading.Event()
+                    restoring = True
+                else:
+                    restoring = False
+            if not restoring:
+                # the session is being stored or restored, look again once it is
+                pending.wait()
+                continue
+
+            worker = None
+            try:
+                worker = self._restore(session_id) or self.factory(session_id)
+            finally:
+                with self._lock:
+                    self._pending.pop(session_id).set()
+                    if worker is not None:
+                        self._sessions[session_id] = (worker, time.monotonic())
+                        evicted = self._evict(keep=session_id)
+            break
+
+        self._persist_all(evicted)
+        self._expire()
+        return worker
+
+    def _restore(self, session_id):
+        if self.store is None:
+            return None
+        data = self.store.load(session_id)
+        if data is None:
+            return None
+        # the session lives in this process until it is evicted again
+        self.store.delete(session_id)
+        settings, steps, generation, traffic_sim = pickle.loads(data)
+        worker = SimulationWorker(traffic_sim)
+        worker.settings.update(settings)
+        worker.steps = steps
+        worker.generation = generation
+        return worker
+
+    def _persist(self, session_id, worker):
+        worker.stop()
+        if self.store is not None:
+            data = pickle.dumps(
+                (worker.settings, worker.steps, worker.generation, worker.traffic_sim),
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+            self.store.save(session_id, data)
+        else:
+            worker.traffic_sim.close()
+
+    def _persist_all(self, evicted):
+        for session_id, worker in evicted:
+            try:
+                self._persist(session_id, worker)
+            finally:
+                with self._lock:
+                    self._pending.pop(session_id).set()
+
+    def _pop(self, session_id):
+        """Takes a session out of memory, to be persisted outside the lock."""
+        worker, _ = self._sessions.pop(session_id)
+        self._pending[session_id] = threading.Event()
+        return session_id, worker
+
+    def _evict(self, keep=None):
+        """Returns the (session id, worker) pairs evicted from memory."""
+        evicted = []
+        now = time.monotonic()
+        for session_id, (worker, last_access) in list(self._sessions.items()):
+            if session_id != keep and now - last_access > self.idle_timeout:
+                evicted.append(self._pop(session_id))
+
+        while len(self._sessions) > self.max_sessions:
+            if not self._evict_oldest(keep, evicted):
+                break
+
+        if self.memory_limit is not None:
+            while self.memory_usage() > self.memory_limit:
+                if not self._evict_oldest(keep, evicted):
+                    break
+        return evicted
+
+    def _evict_oldest(self, keep, evicted):
+        for session_id in self._sessions:
+            if session_id != keep:
+                evicted.append(self._pop(session_id))
+                return True
+        return False
+
+    def _expire(self):
+        if self.store is None:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if self._last_expiry is not None and now - self._last_expiry < self.expire_interval:
+                return
+            self._last_expiry = now
+        for session_id in self.store.expire():
+            if self.on_expire is not None:
+                self.on_expire(session_id)
+
+    def memory_usage(self):
+        """Returns the estimated bytes held by all sessions in this process."""
+        return sum(
+            estimate_memory(worker.traffic_sim) for worker, _ in self._sessions.values()
+        )
+
+    def discard(self, session_id):
+        """Forgets a session, including its stored copy."""
+        with self._lock:
+            worker = None
+            if session_id in self._sessions:
+                worker, _ = self._sessions.pop(session_id)
+            if self.store is not None:
+                self.store.delete(session_id)
+        if worker is not None:
+            worker.stop()
+            worker.traffic_sim.close()
+
+    def close(self):
+        """Evicts every session, saving them to the store when there is one."""
+        with self._lock:
+            evicted = [self._pop(session_id) for session_id in list(self._sessions)]
+        self._persist_all(evicted)
+        if self.store is not None:
+            self.store.close()
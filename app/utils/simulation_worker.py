@@ -0,0 +1,151 @@
+# In[1]:
+# simulation_worker.py
+import copy
+import threading
+import time
+
+from app.utils.vectorized_engine import CarArrays
+
+# In[2]:
+class SimulationFrame:
+    """Immutable copy of the simulation state the figures are drawn from.
+
+    `generation` tells runs of the same worker apart, see SimulationWorker.
+    """
+
+    def __init__(self, cars, statistics, time_elapsed, highway_length, generation=0):
+        self.cars = cars
+        self.statistics = statistics
+        self.time_elapsed = time_elapsed
+        self.highway_length = highway_length
+        self.generation = generation
+
+
+class SimulationWorker:
+    """Steps a HighwayTrafficSimulation on a background thread.
+
+    The thread advances the model every `step_interval` seconds (0 runs as
+    fast as possible) independently of how often the UI redraws. Readers call
+    latest() for a SimulationFrame; the frame is copied under the lock at
+    most once per simulation step, so a slow reader never holds up stepping
+    for longer than the copy.
+
+    `generation` counts the runs of the worker: reset() and
+    load_checkpoint() start a new one, so a reader can tell a restarted
+    clock from a continuing one.
+    """
+
+    def __init__(self, traffic_sim, step_interval=1.0):
+        self.traffic_sim = traffic_sim
+        self.step_interval = step_interval
+        self.settings = {"simulation_type": "simple", "spawn_rate": 50, "lane_value": 5}
+        self.steps = 0
+        self.generation = 0
+
+        self._lock = threading.Lock()
+        self._running = threading.Event()
+        self._shutdown = threading.Event()
+        self._thread = None
+        self._frame = None
+        self._frame_step = None
+
+    def configure(self, step_interval=None, highway_length=None, **settings):
+        """Updates the model parameters used from the next step on."""
+        with self._lock:
+            self.settings.update(settings)
+            if step_interval is not None:
+                self.step_interval = max(0.0, step_interval)
+            if highway_length is not None and highway_length != self.traffic_sim.highway_length:
+                self.traffic_sim.set_highway_length(highway_length)
+
+    def start(self):
+        """Starts or resumes stepping."""
+        self._running.set()
+        if self._thread is None or not self._thread.is_alive():
+            self._shutdown.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def pause(self):
+        """Stops stepping after the current step and flushes the statistics."""
+        self._running.clear()
+        with self._lock:
+            self.traffic_sim.flush_statistics()
+
+    def stop(self):
+        """Ends the background thread."""
+        self._running.clear()
+        self._shutdown.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reset(self):
+        """Pauses and resets the simulation to an empty highway."""
+        self._running.clear()
+        with self._lock:
+            self.traffic_sim.reset()
+            self.steps = 0
+            self.generation += 1
+            self._frame = None
+            self._frame_step = None
+
+    def save_checkpoint(self, path):
+        """Writes a checkpoint of the simulation between two steps."""
+        with self._lock:
+            self.traffic_sim.save_checkpoint(path)
+
+    def load_checkpoint(self, path):
+        """Pauses and replaces the simulation with the one saved at `path`."""
+        self._running.clear()
+        traffic_sim = type(self.traffic_sim).load_checkpoint(path)
+        with self._lock:
+            self.traffic_sim.close()
+            self.traffic_sim = traffic_sim
+            self.steps = traffic_sim.time_elapsed
+            self.generation += 1
+            self._frame = None
+            self._frame_step = None
+
+    def set_recording(self, path):
+        """Starts recording a new trajectory at `path`, or stops for None."""
+        with self._lock:
+            if path is None:
+                self.traffic_sim.stop_recording()
+            elif path != self.traffic_sim.trajectory_path:
+                self.traffic_sim.start_recording(path)
+
+    @property
+    def is_running(self):
+        return self._running.is_set()
+
+    def step(self):
+        """Advances the simulation by one time step."""
+        with self._lock:
+            self.traffic_sim.update(**self.settings)
+            self.steps += 1
+
+    def _run(self):
+        while not self._shutdown.is_set():
+            if not self._running.wait(timeout=0.1):
+                continue
+            started = time.perf_counter()
+            self.step()
+            remaining = self.step_interval - (time.perf_counter() - started)
+            if remaining > 0:
+                self._shutdown.wait(remaining)
+
+    def latest(self):
+        """Returns a SimulationFrame of the most recent simulation step."""
+        with self._lock:
+            if self._frame_step != self.steps:
+                cars = self.traffic_sim.cars
+                self._frame = SimulationFrame(
+                    cars.copy() if isinstance(cars, CarArrays) else CarArrays.from_cars(cars),
+                    copy.deepcopy(self.traffic_sim.statistics),
+                    self.traffic_sim.time_elapsed,
+                    self.traffic_sim.highway_length,
+                    self.generation,
+                )
+                self._frame_step = self.steps
+            return self._frame
@@ -0,0 +1,80 @@
+# In[1]:
+# spatial_index.py
+import numpy as np
+
+# In[2]:
+class CellList:
+    """Uniform grid of cells along the highway for neighbourhood queries.
+
+    Cars are sorted by their (lane, position // cell_size) cell. The cells of
+    one lane are consecutive, so a query finds one contiguous slice per lane
+    with a binary search and costs time proportional to the cars it returns
+    plus the lanes it spans. Only occupied cells are stored, so memory grows
+    with the number of cars, not with the length of the highway. Queries
+    return indices into the sequence the index was built from.
+    """
+
+    def __init__(self, highway_length, cell_size=5):
+        self.cell_size = cell_size
+        self.num_cells = max(1, int(np.ceil(highway_length / cell_size)))
+        self.rebuild([], [])
+
+    def rebuild(self, lanes, positions):
+        """Rebuilds the index from the lane and position of every car."""
+        self.lanes = np.asarray(lanes, dtype=np.int64)
+        self.positions = np.asarray(positions, dtype=np.float64)
+        self.max_lane = int(self.lanes.max()) if len(self.lanes) else 0
+
+        keys = self.lanes * self.num_cells + self._cell(self.positions)
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    def _cell(self, position):
+        cell = np.floor_divide(position, self.cell_size).astype(np.int64)
+        return np.clip(cell, 0, self.num_cells - 1)
+
+    def query(self, lane, position, distance, lane_radius=0):
+        """Returns the indices of the cars within `distance` of `position` in
+        lanes `lane - lane_radius` to `lane + lane_radius`."""
+        first_cell = self._cell(position - distance)
+        last_cell = self._cell(position + distance)
+
+        lanes = np.arange(
+            max(lane - lane_radius, 0), min(lane + lane_radius, self.max_lane) + 1
+        )
+        starts = np.searchsorted(self.keys, lanes * self.num_cells + first_cell, side="left")
+        ends = np.searchsorted(self.keys, lanes * self.num_cells + last_cell, side="right")
+        candidates = [
+            self.order[start:end] for start, end in zip(starts.tolist(), ends.tolist())
+        ]
+        if not candidates:
+            return np.empty(0, dtype=np.int64)
+
+        candidates = np.concatenate(candidates)
+        # the edge cells can hold cars just outside the distance
+        return candidates[np.abs(self.positions[candidates] - position) <= distance]
+
+    def query_pairs(self, lanes, positions, distances):
+        """Batch version of query with one lane per query.
+
+        Returns (query, index) with one entry for every car within
+        `distances[q]` of `positions[q]` in lane `lanes[q]`: the number q of
+        the query and the index of the car. All queries are searched at
+        once, so the cost is the binary searches plus the cars returned.
+        """
+        lanes = np.asarray(lanes, dtype=np.int64)
+        positions = np.asarray(positions, dtype=np.float64)
+        distances = np.broadcast_to(np.asarray(distances, dtype=np.float64), positions.shape)
+
+        base = lanes * self.num_cells
+        starts = np.searchsorted(self.keys, base + self._cell(positions - distances), side="left")
+        ends = np.searchsorted(self.keys, base + self._cell(positions + distances), side="right")
+        counts = ends - starts
+
+        query = np.repeat(np.arange(len(lanes)), counts)
+        # offset of every candidate within the slice of its query
+        offsets = np.arange(len(query)) - np.repeat(np.cumsum(counts) - counts, counts)
+        index = self.order[np.repeat(starts, counts) + offsets]
+        # the edge cells can hold cars just outside the distance
+        near = np.abs(self.positions[index] - positions[query]) <= distances[query]
+        return query[near], index[near]
@@ -0,0 +1,128 @@
+# In[1]:
+# spawning.py
+import numpy as np
+
+from app.utils.vectorized_engine import (
+    CAR_COLORS,
+    DRIVER_CODES,
+    DRIVER_PROFILES,
+    DRIVER_TYPES,
+    CarArrays,
+)
+
+_PROFILES = np.array(DRIVER_PROFILES, dtype=np.float64)
+
+# In[2]: Desired speed distributions
+def uniform_speeds(rng, low, high):
+    """Whole speeds drawn uniformly from every driver's [low, high]."""
+    return np.floor(low + rng.random(len(low)) * (high - low + 1))
+
+
+def normal_speeds(rng, low, high):
+    """Whole speeds around the middle of [low, high], two standard deviations
+    from either end and clipped to it."""
+    middle = (low + high) / 2
+    return np.clip(np.rint(rng.normal(middle, (high - low) / 4)), low, high)
+
+
+# Desired speed distributions by name; a spawner also accepts any callable
+# taking (rng, low, high) arrays and returning one speed per car
+SPEED_DISTRIBUTIONS = {
+    "uniform": uniform_speeds,
+    "normal": normal_speeds,
+}
+
+# In[3]:
+class Spawner:
+    """Draws the cars entering the highway in one vectorized batch per tick.
+
+    Every lane of every replica spawns a car with the spawn probability. The
+    driver types of the new cars follow `driver_mix`, a {driver type: weight}
+    mapping that defaults to an equal share of every type. Their desired
+    speeds follow `speed_distribution` within the speed range of each driver
+    profile. All draws come from one numpy Generator seeded with `seed`.
+    """
+
+    def __init__(self, seed=None, driver_mix=None, speed_distribution="uniform"):
+        self.rng = np.random.default_rng(seed)
+        self.driver_mix = driver_mix
+        self.driver_probabilities = _driver_probabilities(driver_mix)
+        self._cumulative = np.cumsum(self.driver_probabilities)
+        if callable(speed_distribution):
+            self.draw_speeds = speed_distribution
+        elif speed_distribution in SPEED_DISTRIBUTIONS:
+            self.draw_speeds = SPEED_DISTRIBUTIONS[speed_distribution]
+        else:
+            raise ValueError(
+                f"Unknown speed distribution {speed_distribution!r}, "
+                f"expected one of {tuple(SPEED_DISTRIBUTIONS)} or a callable"
+            )
+
+    def spawn(self, spawn_probability, lane_value, replicas=1):
+        """Returns (arrays, replica): the new cars as CarArrays, ordered by
+        replica then lane, and the replica each of them belongs to.
+
+        The cars start at position 0 on lanes 1..lane_value. Their ids are
+        left at 0 for the caller to number.
+        """
+        # one uniform per lane for the spawn decision, the driver type and
+        # the color; a handful of cars per tick is dominated by call overhead
+        uniforms = self.rng.random((3, replicas, lane_value))
+        spawned = uniforms[0] < spawn_probability / 100
+        replica, lane = np.nonzero(spawned)
+        num_cars = len(lane)
+
+        driver_code = np.minimum(
+            np.searchsorted(self._cumulative, uniforms[1][spawned], side="right"),
+            len(DRIVER_TYPES) - 1,
+        ).astype(np.int8)
+        profile = _PROFILES[driver_code]
+        speed = np.asarray(
+            self.draw_speeds(self.rng, profile[:, 3], profile[:, 4]), dtype=np.float64
+        )
+        return (
+            CarArrays.from_columns(
+                lane=lane + 1,
+                position=np.zeros(num_cars),
+                speed=speed,
+                ideal_speed=speed.copy(),
+                safe_distance=profile[:, 0],
+                acceleration=profile[:, 1],
+                deceleration=profile[:, 2],
+                driver_code=driver_code,
+                time=np.zeros(num_cars, dtype=np.int64),
+                happiness=np.full(num_cars, 10.0),
+                time_in_huddle=np.zeros(num_cars, dtype=np.int64),
+                is_in_huddle=np.zeros(num_cars, dtype=np.bool_),
+                id=np.zeros(num_cars, dtype=np.int64),
+                color_code=(uniforms[2][spawned] * len(CAR_COLORS)).astype(np.uint8),
+            ),
+            replica,
+        )
+
+
+def _driver_probabilities(driver_mix):
+    if driver_mix is None:
+        return np.full(len(DRIVER_TYPES), 1 / len(DRIVER_TYPES))
+
+    weights = np.zeros(len(DRIVER_TYPES))
+    for driver_type, weight in driver_mix.items():
+        if driver_type not in DRIVER_CODES:
+            raise ValueError(
+                f"Unknown driver type {driver_type!r}, expected one of {DRIVER_TYPES}"
+            )
+        if weight < 0:
+            raise ValueError(f"Driver mix weights must not be negative, got {weight!r}")
+        weights[DRIVER_CODES[driver_type]] = weight
+    if weights.sum() <= 0:
+        raise ValueError("The driver mix needs at least one positive weight")
+    return weights / weights.sum()
+
+
+def parse_driver_mix(text):
+    """Parses "normal=2,aggressive=1" into {"normal": 2.0, "aggressive": 1.0}."""
+    driver_mix = {}
+    for item in text.split(","):
+        driver_type, _, weight = item.partition("=")
+        driver_mix[driver_type.strip()] = float(weight)
+    return driver_mix
@@ -0,0 +1,306 @@
+# In[1]:
+# statistics_sinks.py
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # parquet output is optional
+    pa = None
+    pq = None
+
+STATISTICS_COLUMNS = [
+    "time_elapsed",
+    "num_cars",
+    "avg_speed",
+    "avg_density",
+    "lane_distribution",
+    "avg_num_cars_per_lane",
+    "happiness_factor",
+    "avg_time_to_exit",
+    # cars that left the highway this tick, in total and per driver type
+    "num_exited",
+    "exited_normal",
+    "exited_aggressive",
+    "exited_cautious",
+]
+
+# In[2]:
+class StatisticsSink:
+    """Buffers statistics rows and appends them to a file in batches.
+
+    Rows are dicts keyed by STATISTICS_COLUMNS. Nothing already on disk is
+    rewritten, so the cost of a tick does not grow with the length of the run.
+    """
+
+    extension = None
+
+    def __init__(self, path, flush_interval=50):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._started = False
+
+    def write(self, row):
+        self._buffer.append(row)
+        if len(self._buffer) >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if not self._started:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._start()
+            self._started = True
+        self._append(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+
+    def checkpoint_state(self):
+        """Flushes and returns what from_checkpoint_state needs, as JSON types."""
+        self.flush()
+        return {"path": self.path, "flush_interval": self.flush_interval, "started": self._started}
+
+    @classmethod
+    def from_checkpoint_state(cls, state):
+        """Recreates a sink that appends to the file given by checkpoint_state."""
+        sink = cls(state["path"], flush_interval=state["flush_interval"])
+        sink._started = state["started"]
+        return sink
+
+    def _start(self):
+        """Creates (or truncates) the output file."""
+        raise NotImplementedError
+
+    def _append(self, rows):
+        raise NotImplementedError
+
+
+class CsvSink(StatisticsSink):
+    """Appends rows to a csv file with the historical statistics layout."""
+
+    extension = "csv"
+
+    def _start(self):
+        with open(self.path, "w") as f:
+            f.write(",".join(STATISTICS_COLUMNS) + "\n")
+
+    def _append(self, rows):
+        with open(self.path, "a") as f:
+            for row in rows:
+                f.write(",".join(f"{row[column]}" for column in STATISTICS_COLUMNS) + "\n")
+
+
+def _record_dtype(max_lanes):
+    return np.dtype(
+        [
+            ("time_elapsed", np.int64),
+            ("num_cars", np.int64),
+            ("avg_speed", np.float64),
+            ("avg_density", np.float64),
+            # padded with zeros past the number of lanes in use
+            ("lane_distribution", np.int64, (max_lanes,)),
+            ("avg_num_cars_per_lane", np.float64),
+            ("happiness_factor", np.float64),
+            ("avg_time_to_exit", np.float64),
+            ("num_exited", np.int64),
+            ("exited_normal", np.int64),
+            ("exited_aggressive", np.int64),
+            ("exited_cautious", np.int64),
+        ]
+    )
+
+
+def _to_records(rows, dtype):
+    max_lanes = dtype["lane_distribution"].shape[0]
+    records = np.zeros(len(rows), dtype=dtype)
+    for i, row in enumerate(rows):
+        for column in STATISTICS_COLUMNS:
+            if column == "lane_distribution":
+                lanes = row[column][:max_lanes]
+                records[i][column][: len(lanes)] = lanes
+            else:
+                records[i][column] = row[column]
+    return records
+
+
+class NpySink(StatisticsSink):
+    """Appends structured records to a single .npy file.
+
+    The header is written with a fixed size and rewritten in place after
+    every flush, so the file is always loadable with np.load.
+    """
+
+    extension = "npy"
+
+    def __init__(self, path, flush_interval=50, max_lanes=8):
+        super().__init__(path, flush_interval=flush_interval)
+        self.dtype = _record_dtype(max_lanes)
+        self._count = 0
+        # room for the largest row count, rounded up to the 64 byte alignment
+        # np.save uses; the magic string and header length take 10 bytes
+        longest = len(self._header_text(2**63 - 1)) + 1
+        self._header_len = -(-(longest + 10) // 64) * 64 - 10
+
+    def checkpoint_state(self):
+        return {**super().checkpoint_state(), "count": self._count}
+
+    @classmethod
+    def from_checkpoint_state(cls, state):
+        sink = super().from_checkpoint_state(state)
+        sink._count = state["count"]
+        return sink
+
+    def _header_text(self, count):
+        return repr(
+            {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": False,
+                "shape": (count,),
+            }
+        )
+
+    def _header(self):
+        header = self._header_text(self._count).ljust(self._header_len - 1) + "\n"
+        return b"\x93NUMPY\x01\x00" + struct.pack("<H", self._header_len) + header.encode("latin1")
+
+    def _start(self):
+        with open(self.path, "wb") as f:
+            f.write(self._header())
+
+    def _append(self, rows):
+        records = _to_records(rows, self.dtype)
+        self._count += len(records)
+        with open(self.path, "r+b") as f:
+            f.seek(0, os.SEEK_END)
+            f.write(records.tobytes())
+            f.seek(0)
+            f.write(self._header())
+
+
+class NpzSink(StatisticsSink):
+    """Appends every flushed batch as a new member of a .npz archive."""
+
+    extension = "npz"
+
+    def __init__(self, path, flush_interval=50, max_lanes=8):
+        super().__init__(path, flush_interval=flush_interval)
+        self.dtype = _record_dtype(max_lanes)
+        self._chunks = 0
+
+    def checkpoint_state(self):
+        return {**super().checkpoint_state(), "chunks": self._chunks}
+
+    @classmethod
+    def from_checkpoint_state(cls, state):
+        sink = super().from_checkpoint_state(state)
+        sink._chunks = state["chunks"]
+        return sink
+
+    def _start(self):
+        with zipfile.ZipFile(self.path, "w"):
+            pass
+
+    def _append(self, rows):
+        records = _to_records(rows, self.dtype)
+        with zipfile.ZipFile(self.path, "a") as archive:
+            with archive.open(f"chunk_{self._chunks:06d}.npy", "w") as member:
+                np.lib.format.write_array(member, records)
+        self._chunks += 1
+
+
+def load_npz_statistics(path):
+    """Concatenates the batches written by NpzSink into one record array."""
+    with np.load(path) as archive:
+        chunks = [archive[name] for name in sorted(archive.files)]
+    return np.concatenate(chunks) if chunks else np.empty(0)
+
+
+class ParquetSink(StatisticsSink):
+    """Appends every flushed batch as a row group of a parquet file."""
+
+    extension = "parquet"
+
+    def __init__(self, path, flush_interval=50):
+        if pa is None:
+            raise ImportError("pyarrow is required for parquet statistics output")
+        super().__init__(path, flush_interval=flush_interval)
+        self._writer = None
+
+    def _start(self):
+        schema = pa.schema(
+            [
+                ("time_elapsed", pa.int64()),
+                ("num_cars", pa.int64()),
+                ("avg_speed", pa.float64()),
+                ("avg_density", pa.float64()),
+                ("lane_distribution", pa.list_(pa.int64())),
+                ("avg_num_cars_per_lane", pa.float64()),
+                ("happiness_factor", pa.float64()),
+                ("avg_time_to_exit", pa.float64()),
+                ("num_exited", pa.int64()),
+                ("exited_normal", pa.int64()),
+                ("exited_aggressive", pa.int64()),
+                ("exited_cautious", pa.int64()),
+            ]
+        )
+        self._writer = pq.ParquetWriter(self.path, schema)
+
+    def _append(self, rows):
+        columns = {
+            column: [row[column] for row in rows] for column in STATISTICS_COLUMNS
+        }
+        self._writer.write_table(
+            pa.Table.from_pydict(columns, schema=self._writer.schema)
+        )
+
+    def close(self):
+        super().close()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def __getstate__(self):
+        # a parquet file cannot be reopened for appending, so a restored sink
+        # continues in a new numbered part file next to the original
+        self.close()
+        state = self.__dict__.copy()
+        if self._started:
+            stem, extension = os.path.splitext(self.path)
+            stem, _, part = stem.partition(".part")
+            state["path"] = f"{stem}.part{int(part or 0) + 1}{extension}"
+            state["_started"] = False
+        return state
+
+    def checkpoint_state(self):
+        # the same for checkpoints, while this sink keeps its own file open
+        state = super().checkpoint_state()
+        if state["started"]:
+            stem, extension = os.path.splitext(self.path)
+            stem, _, part = stem.partition(".part")
+            state["path"] = f"{stem}.part{int(part or 0) + 1}{extension}"
+            state["started"] = False
+        return state
+
+
+SINKS = {
+    "csv": CsvSink,
+    "npy": NpySink,
+    "npz": NpzSink,
+    "parquet": ParquetSink,
+}
+
+
+def make_sink(kind, path_without_extension, **kwargs):
+    """Creates the sink registered under `kind` for the given file stem."""
+    if kind not in SINKS:
+        raise ValueError(f"Unknown statistics sink {kind!r}, expected one of {tuple(SINKS)}")
+    sink_class = SINKS[kind]
+    return sink_class(f"{path_without_extension}.{sink_class.extension}", **kwargs)
@@ -0,0 +1,287 @@
+# In[1]:
+# statistics_store.py
+import numpy as np
+
+from app.utils.statistics_sinks import STATISTICS_COLUMNS
+
+# In[2]:
+class RunningMean:
+    """Mean of a stream of values kept as a running total and count."""
+
+    def __init__(self):
+        self.total = 0
+        self.count = 0
+
+    def add(self, value):
+        self.total += value
+        self.count += 1
+
+    def add_many(self, total, count):
+        self.total += total
+        self.count += count
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+
+class RunningMoments:
+    """Mean and variance of a stream of values, updated without keeping them.
+
+    Batches are merged with Chan's parallel form of Welford's update, which
+    stays accurate where summing squares would cancel.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # sum of squared deviations from the mean
+
+    def add_many(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        count = len(values)
+        if count == 0:
+            return
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self._m2 += m2 + delta**2 * self.count * count / total
+        self.count = total
+
+    def add(self, value):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    @property
+    def variance(self):
+        """Sample variance, 0 below two values."""
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        return self.variance**0.5
+
+    @property
+    def sem(self):
+        """Standard error of the mean."""
+        return (self.variance / self.count) ** 0.5 if self.count else 0.0
+
+
+class RingBuffer:
+    """Preallocated columnar buffer that overwrites its oldest rows when full."""
+
+    def __init__(self, capacity, dtypes):
+        self.capacity = capacity
+        self.columns = {
+            name: np.zeros(capacity, dtype=dtype) for name, dtype in dtypes.items()
+        }
+        self.size = 0
+        self._next = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, row):
+        """Stores a row, returning the row it overwrote or None."""
+        slot = self._next
+        evicted = None
+        if self.size == self.capacity:
+            evicted = {name: column[slot].copy() for name, column in self.columns.items()}
+        else:
+            self.size += 1
+
+        for name, value in row.items():
+            column = self.columns[name]
+            if column.ndim == 2:
+                value = np.asarray(value)
+                if value.shape[0] > column.shape[1]:
+                    column = self._widen(name, value.shape[0])
+                column[slot] = 0
+                column[slot, : value.shape[0]] = value
+            else:
+                column[slot] = value
+
+        self._next = (slot + 1) % self.capacity
+        return evicted
+
+    def _widen(self, name, width):
+        column = self.columns[name]
+        wider = np.zeros((self.capacity, width), dtype=column.dtype)
+        wider[:, : column.shape[1]] = column
+        self.columns[name] = wider
+        return wider
+
+    def ordered(self, name):
+        """Returns a column from the oldest to the newest row."""
+        column = self.columns[name]
+        if self.size < self.capacity:
+            return column[: self.size]
+        return np.concatenate([column[self._next :], column[: self._next]])
+
+    def load(self, columns):
+        """Fills an empty buffer with rows given oldest first, as ordered() returns them."""
+        size = 0
+        for name, values in columns.items():
+            column = self.columns[name]
+            size = len(values)
+            if column.ndim == 2:
+                if values.shape[1] > column.shape[1]:
+                    column = self._widen(name, values.shape[1])
+                column[:size, : values.shape[1]] = values
+            else:
+                column[:size] = values
+        self.size = size
+        self._next = size % self.capacity
+
+
+# In[3]:
+class StatisticsStore:
+    """Bounded time series of the per-tick simulation statistics.
+
+    The latest `retention` ticks are kept at full resolution. Older ticks are
+    averaged in blocks of `downsample` into a second buffer of
+    `history_size` rows, and anything older than that is dropped. Indexing
+    the store with a column name returns that column as a NumPy array.
+    """
+
+    DTYPES = {
+        "time_elapsed": np.int64,
+        "num_cars": np.int64,
+        "avg_speed": np.float64,
+        "avg_density": np.float64,
+        "lane_distribution": np.int64,
+        "avg_num_cars_per_lane": np.float64,
+        "happiness_factor": np.float64,
+        "avg_time_to_exit": np.float64,
+        "num_exited": np.int64,
+        "exited_normal": np.int64,
+        "exited_aggressive": np.int64,
+        "exited_cautious": np.int64,
+    }
+
+    def __init__(self, retention=10_000, downsample=10, history_size=10_000, max_lanes=8):
+        self.downsample = downsample
+        self.history_size = history_size
+        self.recent = RingBuffer(retention, self.DTYPES)
+        self.recent.columns["lane_distribution"] = np.zeros(
+            (retention, max_lanes), dtype=np.int64
+        )
+        self.history = None
+        if downsample and history_size:
+            self.history = RingBuffer(
+                history_size, {name: np.float64 for name in self.DTYPES}
+            )
+            self.history.columns["lane_distribution"] = np.zeros(
+                (history_size, max_lanes), dtype=np.float64
+            )
+        self._pending = []
+        self._means = {
+            name: RunningMean() for name in self.DTYPES if name != "lane_distribution"
+        }
+        self.total_ticks = 0
+
+    def __len__(self):
+        return len(self.recent)
+
+    def __getitem__(self, name):
+        return self.recent.ordered(name)
+
+    def append(self, row):
+        """Records one tick; `row` maps every STATISTICS_COLUMNS name to a value."""
+        for name, running_mean in self._means.items():
+            running_mean.add(row[name])
+        self.total_ticks += 1
+
+        evicted = self.recent.append({name: row[name] for name in STATISTICS_COLUMNS})
+        if evicted is not None and self.history is not None:
+            self._pending.append(evicted)
+            if len(self._pending) == self.downsample:
+                self.history.append(self._block_mean(self._pending))
+                self._pending = []
+
+    @staticmethod
+    def _block_mean(rows):
+        width = max(len(row["lane_distribution"]) for row in rows)
+        block = {}
+        for name in rows[0]:
+            if name == "lane_distribution":
+                lanes = np.zeros((len(rows), width))
+                for i, row in enumerate(rows):
+                    lanes[i, : len(row[name])] = row[name]
+                block[name] = lanes.mean(axis=0)
+            else:
+                block[name] = np.mean([row[name] for row in rows])
+        return block
+
+    def checkpoint_state(self):
+        """Returns (state, columns) for a checkpoint: the settings and running
+        means as JSON types, and only the rows filled so far as arrays."""
+        columns = {}
+        buffers = {"recent": self.recent, "history": self.history}
+        for prefix, buffer in buffers.items():
+            if buffer is not None:
+                for name in buffer.columns:
+                    columns[f"{prefix}_{name}"] = buffer.ordered(name)
+        if self._pending:
+            width = max(len(row["lane_distribution"]) for row in self._pending)
+            for name in self.DTYPES:
+                if name == "lane_distribution":
+                    lanes = np.zeros((len(self._pending), width), dtype=np.int64)
+                    for i, row in enumerate(self._pending):
+                        lanes[i, : len(row[name])] = row[name]
+                    columns[f"pending_{name}"] = lanes
+                else:
+                    columns[f"pending_{name}"] = np.array([row[name] for row in self._pending])
+
+        state = {
+            "retention": self.recent.capacity,
+            "downsample": self.downsample,
+            "history_size": self.history_size,
+            "max_lanes": self.recent.columns["lane_distribution"].shape[1],
+            "means": {name: [mean.total, mean.count] for name, mean in self._means.items()},
+            "total_ticks": self.total_ticks,
+        }
+        return state, columns
+
+    @classmethod
+    def from_checkpoint_state(cls, state, columns):
+        """Rebuilds a store from what checkpoint_state returned."""
+        store = cls(
+            retention=state["retention"],
+            downsample=state["downsample"],
+            history_size=state["history_size"],
+            max_lanes=state["max_lanes"],
+        )
+        buffers = {"recent": store.recent, "history": store.history}
+        for prefix, buffer in buffers.items():
+            if buffer is not None:
+                buffer.load({name: columns[f"{prefix}_{name}"] for name in buffer.columns})
+        if "pending_time_elapsed" in columns:
+            store._pending = [
+                {name: columns[f"pending_{name}"][i] for name in cls.DTYPES}
+                for i in range(len(columns["pending_time_elapsed"]))
+            ]
+        for name, (total, count) in state["means"].items():
+            store._means[name].total = total
+            store._means[name].count = count
+        store.total_ticks = state["total_ticks"]
+        return store
+
+    def last(self, name):
+        """Returns the most recent value of a column."""
+        return self[name][-1]
+
+    def mean(self, name):
+        """Returns the mean of a scalar column over every tick ever recorded."""
+        return self._means[name].mean
+
+    def downsampled(self, name):
+        """Returns the block averages of the ticks older than the retention window."""
+        if self.history is None:
+            return np.empty(0)
+        return self.history.ordered(name)
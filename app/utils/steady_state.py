@@ -0,0 +1,188 @@
+# In[1]:
+# steady_state.py
+from collections import deque
+
+from app.utils.statistics_store import RunningMoments
+
+# Statistics watched by default: the flow of the traffic and how much of it
+# there is
+STEADY_STATE_COLUMNS = ("avg_speed", "num_cars")
+
+# In[2]:
+class SteadyStateDetector:
+    """Online test for the end of a simulation's warm-up.
+
+    The per-tick values of every watched column are averaged over
+    consecutive windows of `window` ticks. When a window completes, each
+    column's mean is compared with the mean of the previous window. The
+    column has stopped drifting if the two means differ by no more than
+    `tolerance` times the previous mean, or by no more than `z` standard
+    errors of their difference, whichever is larger. Successive ticks of a
+    traffic jam are strongly correlated, so each standard error uses the
+    effective number of independent ticks of its window, estimated from the
+    lag-1 autocorrelation. The run is steady once every column has passed
+    `patience` windows in a row. From then on, `converged_at` holds the tick
+    of that last window and `steady_values` holds each column's mean over
+    the passing windows.
+
+    Every tick costs one running-moment update per column, and only the last
+    few windows are kept.
+    """
+
+    def __init__(
+        self,
+        columns=STEADY_STATE_COLUMNS,
+        window=200,
+        tolerance=0.02,
+        z=2.0,
+        patience=2,
+    ):
+        self.columns = tuple(columns)
+        self.window = window
+        self.tolerance = tolerance
+        self.z = z
+        self.patience = patience
+        self.reset()
+
+    def reset(self):
+        """Forgets every tick seen so far."""
+        self._windows = deque(maxlen=self.patience + 1)
+        self._current = self._new_window()
+        self._streak = 0
+        self.converged_at = None
+        self.steady_values = None
+
+    def checkpoint_state(self):
+        """Returns the settings and the windows seen so far as JSON types."""
+        return {
+            "columns": self.columns,
+            "window": self.window,
+            "tolerance": self.tolerance,
+            "z": self.z,
+            "patience": self.patience,
+            "windows": [
+                {name: window[name].checkpoint_state() for name in self.columns}
+                for window in self._windows
+            ],
+            "current": {name: self._current[name].checkpoint_state() for name in self.columns},
+            "streak": self._streak,
+            "converged_at": self.converged_at,
+            "steady_values": self.steady_values,
+        }
+
+    @classmethod
+    def from_checkpoint_state(cls, state):
+        """Rebuilds a detector from what checkpoint_state returned."""
+        detector = cls(
+            state["columns"],
+            window=state["window"],
+            tolerance=state["tolerance"],
+            z=state["z"],
+            patience=state["patience"],
+        )
+        for window in state["windows"]:
+            detector._windows.append(
+                {name: _Window.from_checkpoint_state(window[name]) for name in detector.columns}
+            )
+        detector._current = {
+            name: _Window.from_checkpoint_state(state["current"][name])
+            for name in detector.columns
+        }
+        detector._streak = state["streak"]
+        detector.converged_at = state["converged_at"]
+        detector.steady_values = state["steady_values"]
+        return detector
+
+    def _new_window(self):
+        return {name: _Window() for name in self.columns}
+
+    @property
+    def converged(self):
+        return self.converged_at is not None
+
+    def _stable(self, previous, current):
+        difference = abs(current.moments.mean - previous.moments.mean)
+        noise = self.z * (previous.sem**2 + current.sem**2) ** 0.5
+        return difference <= max(self.tolerance * abs(previous.moments.mean), noise)
+
+    def update(self, row):
+        """Feeds one tick of statistics, returns True once the run is steady."""
+        if self.converged_at is not None:
+            return True
+
+        current = self._current
+        for name in self.columns:
+            current[name].add(float(row[name]))
+        if current[self.columns[0]].moments.count < self.window:
+            return False
+
+        previous = self._windows[-1] if self._windows else None
+        if previous is not None and all(
+            self._stable(previous[name], current[name]) for name in self.columns
+        ):
+            self._streak += 1
+        else:
+            self._streak = 0
+        self._windows.append(current)
+        self._current = self._new_window()
+
+        if self._streak >= self.patience:
+            self.converged_at = row["time_elapsed"]
+            self.steady_values = {
+                name: sum(window[name].moments.mean for window in self._windows)
+                / len(self._windows)
+                for name in self.columns
+            }
+            return True
+        return False
+
+
+class _Window:
+    """Running moments of one column over one window, plus the sums needed
+    for its lag-1 autocorrelation."""
+
+    __slots__ = ("moments", "first", "last", "lag_products")
+
+    def __init__(self):
+        self.moments = RunningMoments()
+        self.first = None
+        self.last = None
+        self.lag_products = 0.0  # sum of x[t] * x[t - 1]
+
+    def checkpoint_state(self):
+        moments = self.moments
+        return [moments.count, moments.mean, moments._m2, self.first, self.last, self.lag_products]
+
+    @classmethod
+    def from_checkpoint_state(cls, state):
+        window = cls()
+        count, mean, m2, window.first, window.last, window.lag_products = state
+        window.moments.count = count
+        window.moments.mean = mean
+        window.moments._m2 = m2
+        return window
+
+    def add(self, value):
+        if self.last is None:
+            self.first = value
+        else:
+            self.lag_products += value * self.last
+        self.last = value
+        self.moments.add(value)
+
+    @property
+    def sem(self):
+        """Standard error of the window mean, corrected for autocorrelation."""
+        moments = self.moments
+        count, mean, variance = moments.count, moments.mean, moments.variance
+        if count < 3 or variance == 0:
+            return 0.0
+        total = mean * count
+        autocovariance = (
+            self.lag_products
+            - mean * ((total - self.first) + (total - self.last))
+            + (count - 1) * mean**2
+        ) / (count - 1)
+        rho = min(max(autocovariance / variance, 0.0), 0.99)
+        effective_count = max(count * (1 - rho) / (1 + rho), 1.0)
+        return (variance / effective_count) ** 0.5
@@ -0,0 +1,272 @@
+# In[1]:
+# trajectory.py
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from app.utils.simulation_worker import SimulationFrame
+from app.utils.vectorized_engine import CarArrays
+
+TRAJECTORY_VERSION = 3
+
+# One record per car per tick, 24 bytes instead of a full CarArrays row
+CAR_RECORD_DTYPE = np.dtype(
+    [
+        ("id", np.int64),
+        ("lane", np.int16),
+        ("driver_code", np.int8),
+        ("color_code", np.uint8),
+        ("position", np.float32),
+        ("speed", np.float32),
+        ("happiness", np.float32),
+    ]
+)
+
+# One record per tick: where its cars are, the controls that produced it and
+# the statistics drawn under the highway
+TICK_RECORD_DTYPE = np.dtype(
+    [
+        ("time_elapsed", np.int64),
+        ("start", np.int64),
+        ("count", np.int64),
+        ("simulation_type", "U16"),
+        ("spawn_rate", np.int32),
+        ("lane_value", np.int32),
+        ("highway_length", np.float64),
+        ("avg_speed", np.float64),
+        ("avg_density", np.float64),
+    ]
+)
+
+# In[2]: Writing
+class TrajectoryWriter:
+    """Appends the state of every car at every tick to a trajectory directory.
+
+    `cars.bin` holds CAR_RECORD_DTYPE records of all ticks back to back and
+    `ticks.bin` one TICK_RECORD_DTYPE record per tick pointing into it. Ticks
+    are buffered and appended `chunk_size` at a time, cars before ticks, so a
+    Trajectory opened on a run in progress only ever sees complete ticks.
+    Together with the seed in `meta.json`, the recorded controls replay the
+    run exactly. With `max_bytes`, recording stops for good at the first
+    tick that would grow `cars.bin` past it, and `full` is set.
+
+    Creating a writer starts a new trajectory at `path`, replacing any
+    trajectory already there. Files are only ever appended to or replaced
+    by new ones, never truncated, so a Trajectory still mapping the old
+    files keeps reading them safely.
+    """
+
+    def __init__(self, path, chunk_size=100, meta=None, max_bytes=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.full = False
+        self.ticks_written = 0
+        self.records_written = 0
+        self._cars = []
+        self._ticks = []
+        self._records_buffered = 0
+
+        os.makedirs(path, exist_ok=True)
+        for name in ("cars.bin", "ticks.bin"):
+            _replace_with_prefix(os.path.join(path, name), 0)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"version": TRAJECTORY_VERSION, **(meta or {})}, f)
+
+    def record(
+        self,
+        time_elapsed,
+        arrays,
+        simulation_type,
+        spawn_rate,
+        lane_value,
+        highway_length,
+        avg_speed=np.nan,
+        avg_density=np.nan,
+    ):
+        """Buffers the cars of one tick, given as CarArrays."""
+        if self.full:
+            return
+        start = self.records_written + self._records_buffered
+        if (
+            self.max_bytes is not None
+            and (start + len(arrays)) * CAR_RECORD_DTYPE.itemsize > self.max_bytes
+        ):
+            self.full = True
+            self.flush()
+            return
+
+        cars = np.empty(len(arrays), dtype=CAR_RECORD_DTYPE)
+        for name in CAR_RECORD_DTYPE.names:
+            cars[name] = getattr(arrays, name)
+
+        self._cars.append(cars)
+        self._records_buffered += len(cars)
+        self._ticks.append(
+            (
+                time_elapsed,
+                start,
+                len(cars),
+                simulation_type,
+                spawn_rate,
+                lane_value,
+                highway_length,
+                avg_speed,
+                avg_density,
+            )
+        )
+        if len(self._ticks) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._ticks:
+            return
+        cars = np.concatenate(self._cars)
+        ticks = np.array(self._ticks, dtype=TICK_RECORD_DTYPE)
+        with open(os.path.join(self.path, "cars.bin"), "ab") as f:
+            f.write(cars.tobytes())
+        with open(os.path.join(self.path, "ticks.bin"), "ab") as f:
+            f.write(ticks.tobytes())
+        self.records_written += len(cars)
+        self.ticks_written += len(ticks)
+        self._cars = []
+        self._ticks = []
+        self._records_buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def __getstate__(self):
+        self.flush()
+        return self.__dict__.copy()
+
+    def checkpoint_state(self):
+        """Flushes and returns what from_checkpoint_state needs, as JSON types."""
+        self.flush()
+        return {
+            "path": self.path,
+            "chunk_size": self.chunk_size,
+            "max_bytes": self.max_bytes,
+            "full": self.full,
+            "ticks_written": self.ticks_written,
+            "records_written": self.records_written,
+        }
+
+    @classmethod
+    def from_checkpoint_state(cls, state):
+        """Reopens a trajectory at the length given by checkpoint_state,
+        leaving its files alone until resume() is called."""
+        writer = cls.__new__(cls)
+        writer.__dict__.update(state)
+        writer._cars = []
+        writer._ticks = []
+        writer._records_buffered = 0
+        return writer
+
+    def resume(self):
+        """Cuts the files back to the ticks this writer has written.
+
+        A writer restored from a checkpoint calls this before recording
+        again, dropping whatever a later run at the same path appended after
+        the checkpoint.
+        """
+        for name, size in (
+            ("cars.bin", self.records_written * CAR_RECORD_DTYPE.itemsize),
+            ("ticks.bin", self.ticks_written * TICK_RECORD_DTYPE.itemsize),
+        ):
+            path = os.path.join(self.path, name)
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                _replace_with_prefix(path, size)
+
+
+def _replace_with_prefix(path, size):
+    """Replaces the file at `path` by a new file holding its first `size` bytes.
+
+    Truncating a file in place makes every process that maps the cut part
+    fail with SIGBUS on its next read. A new file leaves existing maps on
+    the old one.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as tmp:
+        if size:
+            with open(path, "rb") as f:
+                while size:
+                    chunk = f.read(min(size, 2**24))
+                    if not chunk:
+                        break
+                    tmp.write(chunk)
+                    size -= len(chunk)
+    os.replace(tmp_path, path)
+
+
+# In[3]: Reading
+def _map(path, dtype):
+    count = os.path.getsize(path) // dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count,))
+
+
+class Trajectory:
+    """Memory-mapped view of a trajectory written by TrajectoryWriter.
+
+    Seeking to a tick reads only the records of that tick, so any tick of a
+    run of any length can be shown at display rate.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != TRAJECTORY_VERSION:
+            raise ValueError(
+                f"{path} has trajectory version {self.meta.get('version')}, "
+                f"expected {TRAJECTORY_VERSION}"
+            )
+        self._sizes = None
+        self.refresh()
+
+    def refresh(self):
+        """Picks up ticks appended, or files replaced, since the last refresh."""
+        sizes = tuple(
+            (stat.st_ino, stat.st_size)
+            for stat in (
+                os.stat(os.path.join(self.path, name)) for name in ("cars.bin", "ticks.bin")
+            )
+        )
+        if sizes != self._sizes:
+            self.cars = _map(os.path.join(self.path, "cars.bin"), CAR_RECORD_DTYPE)
+            self.ticks = _map(os.path.join(self.path, "ticks.bin"), TICK_RECORD_DTYPE)
+            self._sizes = sizes
+        return self
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def cars_at(self, index):
+        """Returns the cars of tick `index` as CarArrays."""
+        tick = self.ticks[index]
+        records = self.cars[tick["start"] : tick["start"] + tick["count"]]
+
+        arrays = CarArrays()
+        for name in CAR_RECORD_DTYPE.names:
+            setattr(arrays, name, records[name].astype(CarArrays.FIELDS[name]))
+        return arrays
+
+    def frame(self, index, max_points=1000):
+        """Returns a SimulationFrame of tick `index`.
+
+        The statistics cover the ticks up to `index` that had cars on the
+        highway, thinned out to at most about `max_points` points.
+        """
+        history = self.ticks[: index + 1]
+        history = history[:: max(1, len(history) // max_points)]
+        tick = self.ticks[index]
+        return SimulationFrame(
+            self.cars_at(index),
+            np.asarray(history[history["count"] > 0]),
+            int(tick["time_elapsed"]),
+            float(tick["highway_length"]),
+        )
@@ -1,7 +1,11 @@
 # In[1]: Imports
 import plotly.graph_objects as go
+import numpy as np
+from dash import Patch
+import math
 import os
 import sys
+from functools import lru_cache
 
 # Set the working directory to the directory of this file
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -9,12 +13,38 @@ os.chdir(current_dir)
 sys.path.append(current_dir)
 
 from app.utils.highway_traffic_and_car_sim import HIGHWAY_LENGTH
+from app.utils.vectorized_engine import CAR_COLORS, CarArrays, DRIVER_TYPES
+
+VIEWPORT_LENGTH = 1000  # longest stretch of road drawn without zooming
+MAX_LANE_MARKERS = 200  # dashes per lane line, spaced out on long stretches
+MARKER_LIMIT = 5000  # more visible cars than this are drawn as a density heatmap
+DENSITY_BINS = 400  # heatmap cells along the road
 
 # In[2]: Define functions
-def create_figure(lane_slider_value, traffic_sim):
+def visible_range(traffic_sim, viewport=None):
+    """Returns the (start, end) stretch of road to draw.
+
+    `viewport` is the [start, end] the browser zoomed to, with an end of None
+    meaning the end of the road. Without one, roads up to VIEWPORT_LENGTH are
+    drawn whole and longer ones from their start.
+    """
+    length = traffic_sim.highway_length
+    default = (0, min(length, VIEWPORT_LENGTH))
+    if viewport is None:
+        return default
+    start, end = viewport
+    start = max(0, start)
+    end = length if end is None else min(end, length)
+    return (start, end) if end > start else default
+
+
+@lru_cache(maxsize=64)
+def road_traces(lane_slider_value, start=0, end=HIGHWAY_LENGTH):
+    """Builds the static road background and lane markers once per lane count
+    and stretch of road."""
     # Road background (gray area)
     road_background = go.Scatter(
-        x=[0, HIGHWAY_LENGTH, HIGHWAY_LENGTH, 0, 0],
+        x=[start, end, end, start, start],
         y=[-0.5, -0.5, lane_slider_value - 0.5, lane_slider_value - 0.5, -0.5],
         fill="toself",
         fillcolor="lightgray",
@@ -23,40 +53,120 @@ def create_figure(lane_slider_value, traffic_sim):
         hoverinfo="none",
     )
 
-    # Lane markers (dashed white lines)
-    lane_lines = [
-        go.Scatter(
-            x=[i for i in range(0, HIGHWAY_LENGTH, 5)],
-            y=[lane + 0.5] * (HIGHWAY_LENGTH // 5),
-            mode="markers",
-            marker=dict(size=2, color="white", symbol="line-ew"),
-            hoverinfo="none",
+    # Lane markers (dashed white lines), all lanes in a single trace, spaced
+    # further apart on long stretches so their number stays bounded
+    spacing = 5 * max(1, math.ceil((end - start) / (5 * MAX_LANE_MARKERS)))
+    marker_x = list(range(math.ceil(start / spacing) * spacing, math.ceil(end), spacing))
+    lane_lines = go.Scatter(
+        x=marker_x * (lane_slider_value - 1),
+        y=[lane + 0.5 for lane in range(lane_slider_value - 1) for _ in marker_x],
+        mode="markers",
+        marker=dict(size=2, color="white", symbol="line-ew"),
+        hoverinfo="none",
+    )
+
+    return (road_background, lane_lines)
+
+
+def _car_arrays(traffic_sim):
+    cars = traffic_sim.cars
+    return cars if isinstance(cars, CarArrays) else CarArrays.from_cars(cars)
+
+
+def car_columns(traffic_sim, start=0, end=math.inf):
+    """Returns the position, lane, speed, color and driver type of every car
+    between `start` and `end`."""
+    cars = _car_arrays(traffic_sim)
+    visible = (cars.position >= start) & (cars.position <= end)
+    return (
+        cars.position[visible],
+        cars.lane[visible],
+        cars.speed[visible],
+        np.array(CAR_COLORS, dtype=object)[cars.color_code[visible]],
+        np.array(DRIVER_TYPES, dtype=object)[cars.driver_code[visible]],
+    )
+
+
+def density_grid(position, lane, speed, lanes, start, end, bins=DENSITY_BINS):
+    """Bins cars into a (lane, position) grid.
+
+    Returns the bin centers along the road, then the cars per unit of road
+    and the mean speed of every bin, both of shape (lanes, bins).
+    """
+    bins = max(1, min(bins, math.ceil(end - start)))
+    width = (end - start) / bins
+    column = np.clip(((position - start) / width).astype(np.int64), 0, bins - 1)
+    in_lanes = (lane >= 1) & (lane <= lanes)
+    cell = (lane[in_lanes] - 1) * bins + column[in_lanes]
+
+    counts = np.bincount(cell, minlength=lanes * bins).reshape(lanes, bins)
+    speed_sums = np.bincount(cell, weights=speed[in_lanes], minlength=lanes * bins)
+    mean_speed = np.divide(
+        speed_sums.reshape(lanes, bins), counts, out=np.zeros((lanes, bins)), where=counts > 0
+    )
+    centers = start + (np.arange(bins) + 0.5) * width
+    return centers, counts / width, mean_speed
+
+
+def car_trace(lane_slider_value, traffic_sim, start, end):
+    """Returns the trace drawing the cars between `start` and `end`.
+
+    Up to MARKER_LIMIT cars are drawn as one marker each. Above that the
+    cars are aggregated into a lane by position density heatmap, whose size
+    depends on the number of bins instead of the number of cars; zooming in
+    far enough brings the markers back.
+    """
+    cars = _car_arrays(traffic_sim)
+    visible = (cars.position >= start) & (cars.position <= end)
+
+    if np.count_nonzero(visible) > MARKER_LIMIT:
+        centers, density, mean_speed = density_grid(
+            cars.position[visible],
+            cars.lane[visible],
+            cars.speed[visible],
+            lane_slider_value,
+            start,
+            end,
+        )
+        lane_numbers = np.broadcast_to(
+            np.arange(1, lane_slider_value + 1)[:, None], density.shape
         )
-        for lane in range(lane_slider_value - 1)
-    ]
-
-    # Car representations
-    car_data = []
-    for car in traffic_sim.cars:
-        car_data.append(
-            go.Scatter(
-                x=[car.position],
-                y=[car.lane - 1],  # Centering cars in lanes
-                mode="markers",
-                marker=dict(size=15, color=car.color, symbol="circle", opacity=0.9),
-                hovertext=f"Lane: {car.lane}, Speed: {car.speed:.1f}, Type: {car.driver_type}",
-                hoverinfo="text",
-            )
+        return go.Heatmap(
+            x=centers,
+            y=np.arange(lane_slider_value),  # Centering rows in lanes
+            z=density,
+            zmin=0,
+            colorscale="YlOrRd",
+            colorbar=dict(title="Cars per unit"),
+            customdata=np.stack([lane_numbers, mean_speed], axis=-1),
+            hovertemplate="Lane: %{customdata[0]}, Position: %{x:.0f}, "
+            "Density: %{z:.2f}, Speed: %{customdata[1]:.1f}<extra></extra>",
         )
 
+    position, lane, speed, color, driver_type = car_columns(traffic_sim, start, end)
+
+    # Car representations, one WebGL trace for every car on the highway
+    return go.Scattergl(
+        x=position,
+        y=lane - 1,  # Centering cars in lanes
+        mode="markers",
+        marker=dict(size=15, color=color, symbol="circle", opacity=0.9),
+        customdata=np.column_stack([lane, speed, driver_type]),
+        hovertemplate="Lane: %{customdata[0]}, Speed: %{customdata[1]:.1f}, "
+        "Type: %{customdata[2]}<extra></extra>",
+    )
+
+
+def create_figure(lane_slider_value, traffic_sim, viewport=None):
+    start, end = visible_range(traffic_sim, viewport)
+    car_data = car_trace(lane_slider_value, traffic_sim, start, end)
+
     # Create the figure
     fig = {
-        "data": [road_background] + lane_lines + car_data,
+        "data": [*road_traces(lane_slider_value, start, end), car_data],
         "layout": go.Layout(
             title="Highway Traffic Simulation",
-            xaxis=dict(
-                range=[0, HIGHWAY_LENGTH], title="Highway Position", showgrid=False
-            ),
+            xaxis=dict(range=[start, end], title="Highway Position", showgrid=False),
             yaxis=dict(
                 range=[-1, lane_slider_value],
                 title="Lanes",
@@ -69,12 +179,30 @@ def create_figure(lane_slider_value, traffic_sim):
             plot_bgcolor="white",
             margin=dict(l=50, r=50, b=50, t=50),
             height=500,
+            # keep the browser's zoom until the road itself changes
+            uirevision=f"{lane_slider_value}-{traffic_sim.highway_length}",
         ),
     }
 
     return fig
 
 
+def car_trace_patch(lane_slider_value, traffic_sim, viewport=None):
+    """Returns a Patch that only replaces the car trace of a create_figure figure.
+
+    The whole trace is replaced, so the patch also switches between markers
+    and the density heatmap when the number of visible cars crosses
+    MARKER_LIMIT.
+    """
+    start, end = visible_range(traffic_sim, viewport)
+
+    patched = Patch()
+    patched["data"][len(road_traces(lane_slider_value, start, end))] = car_trace(
+        lane_slider_value, traffic_sim, start, end
+    ).to_plotly_json()
+    return patched
+
+
 def create_placeholder_figure(filepath):
     fig = go.Figure()
 
@@ -110,9 +238,9 @@ def create_placeholder_figure(filepath):
 def create_figure_statisticts(traffic_sim):
     """Creates a figure displaying the traffic simulation statistics over time."""
 
-    stats = traffic_sim.statistics  # Extract statistics dictionary
+    stats = traffic_sim.statistics  # Extract statistics store
 
-    if not stats["time_elapsed"]:  # Ensure there's data to plot
+    if len(stats) == 0:  # Ensure there's data to plot
         return go.Figure()  # Return an empty figure if no data exists
 
     fig = go.Figure()
@@ -160,6 +288,26 @@ def create_figure_statisticts(traffic_sim):
 
     return fig
 
+
+def statistics_extension(traffic_sim, since):
+    """Returns the extendData payload for the statistics recorded after `since`.
+
+    The traces match create_figure_statisticts: average speed, then density.
+    """
+    stats = traffic_sim.statistics
+    time_elapsed = stats["time_elapsed"]
+    new = time_elapsed > since
+
+    return (
+        dict(
+            x=[time_elapsed[new], time_elapsed[new]],
+            y=[stats["avg_speed"][new], stats["avg_density"][new]],
+        ),
+        [0, 1],
+        stats.recent.capacity,  # keep the browser history as long as the store's
+    )
+
+
 def collapse_button(n, is_open):
     if n:
         return not is_open
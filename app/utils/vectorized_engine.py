@@ -0,0 +1,298 @@
+# In[1]:
+# vectorized_engine.py
+import itertools
+from collections import namedtuple
+
+import numpy as np
+
+DRIVER_TYPES = ("normal", "aggressive", "cautious")
+DRIVER_CODES = {name: code for code, name in enumerate(DRIVER_TYPES)}
+
+# Driving style of every driver type, indexed by driver code
+DriverProfile = namedtuple(
+    "DriverProfile",
+    ["safe_distance", "acceleration", "deceleration", "min_speed", "max_speed"],
+)
+DRIVER_PROFILES = (
+    DriverProfile(2, 0.5, 1.0, 3, 8),  # normal
+    DriverProfile(1, 1.0, 1.5, 5, 10),  # aggressive
+    DriverProfile(3, 0.3, 0.8, 2, 6),  # cautious
+)
+
+# Car colors, indexed by color code: every mix of six shades per channel
+CAR_COLORS = tuple(
+    f"rgb({red}, {green}, {blue})"
+    for red, green, blue in itertools.product(range(50, 201, 30), repeat=3)
+)
+_COLOR_ARRAY = np.array(CAR_COLORS, dtype=object)
+
+# In[2]:
+class CarView:
+    """Read-only view of one car stored in a CarArrays instance."""
+
+    __slots__ = ("_arrays", "_index")
+
+    def __init__(self, arrays, index):
+        self._arrays = arrays
+        self._index = index
+
+    def __getattr__(self, name):
+        if name == "driver_type":
+            return DRIVER_TYPES[self._arrays.driver_code[self._index]]
+        if name == "color":
+            return CAR_COLORS[self._arrays.color_code[self._index]]
+        if name in CarArrays.FIELDS:
+            value = getattr(self._arrays, name)[self._index]
+            return value.item() if isinstance(value, np.generic) else value
+        raise AttributeError(name)
+
+
+class CarArrays:
+    """Structure-of-arrays storage for every car on the highway."""
+
+    FIELDS = {
+        "lane": np.int64,
+        "position": np.float64,
+        "speed": np.float64,
+        "ideal_speed": np.float64,
+        "safe_distance": np.float64,
+        "acceleration": np.float64,
+        "deceleration": np.float64,
+        "driver_code": np.int8,
+        "time": np.int64,
+        "happiness": np.float64,
+        "time_in_huddle": np.int64,
+        "is_in_huddle": np.bool_,
+        "id": np.int64,
+        "color_code": np.uint8,
+    }
+
+    def __init__(self):
+        for name, dtype in self.FIELDS.items():
+            setattr(self, name, np.empty(0, dtype=dtype))
+
+    @classmethod
+    def from_cars(cls, cars):
+        """Builds the arrays from a list of Car objects."""
+        arrays = cls()
+        arrays.append_cars(cars)
+        return arrays
+
+    @classmethod
+    def from_columns(cls, **columns):
+        """Builds the arrays from one array per field, without copying them."""
+        arrays = cls.__new__(cls)
+        for name in cls.FIELDS:
+            setattr(arrays, name, columns[name])
+        return arrays
+
+    @property
+    def color(self):
+        """Returns the color string of every car as an object array."""
+        return _COLOR_ARRAY[self.color_code]
+
+    def copy(self):
+        """Returns an independent copy of every array."""
+        arrays = CarArrays()
+        for name in self.FIELDS:
+            setattr(arrays, name, getattr(self, name).copy())
+        return arrays
+
+    def __len__(self):
+        return len(self.lane)
+
+    def __iter__(self):
+        return (CarView(self, i) for i in range(len(self)))
+
+    def append_cars(self, cars):
+        """Appends Car objects to the arrays, keeping their order."""
+        if not cars:
+            return
+        for name, dtype in self.FIELDS.items():
+            new = [getattr(car, name) for car in cars]
+            setattr(self, name, np.concatenate([getattr(self, name), np.array(new, dtype=dtype)]))
+
+    def append_arrays(self, other):
+        """Appends the cars of another CarArrays instance."""
+        for name in self.FIELDS:
+            setattr(self, name, np.concatenate([getattr(self, name), getattr(other, name)]))
+
+    def compact(self, keep):
+        """Keeps only the cars selected by the boolean mask `keep`."""
+        for name in self.FIELDS:
+            setattr(self, name, getattr(self, name)[keep])
+
+    def lane_order(self):
+        """Returns indices sorting the cars by lane, then position.
+
+        The sort is stable, so ties keep their storage order exactly like
+        the sorted() call in HighwayTrafficSimulation._sort_cars_in_lane.
+        """
+        return np.lexsort((self.position, self.lane))
+
+    def leaders(self, order):
+        """Returns (rear, front) index pairs of consecutive cars in a lane."""
+        rear = order[:-1]
+        front = order[1:]
+        same_lane = self.lane[rear] == self.lane[front]
+        return rear[same_lane], front[same_lane]
+
+
+# In[3]:
+def step_simple(arrays):
+    """Vectorized equivalent of HighwayTrafficSimulation.update_simple."""
+    rear, front = arrays.leaders(arrays.lane_order())
+
+    position = arrays.position
+    speed = arrays.speed
+    new_position = position + speed
+
+    # every rear car reads the state of its leader before this step
+    blocked = new_position[rear] >= (
+        new_position[front] - arrays.safe_distance[rear]
+    )
+    blocked_rear = rear[blocked]
+    blocked_front = front[blocked]
+
+    new_speed = speed.copy()
+    new_speed[blocked_rear] = np.minimum(speed[blocked_front], speed[blocked_rear])
+    new_position[blocked_rear] = (
+        position[blocked_front] - arrays.safe_distance[blocked_rear]
+    )
+    arrays.happiness[blocked_rear] -= 3
+
+    arrays.position = new_position
+    arrays.speed = new_speed
+
+
+def step_individualistic(arrays, lane_value, lane_offset=0):
+    """Vectorized equivalent of HighwayTrafficSimulation.update_individualistic.
+
+    `lane_offset` is subtracted from every lane before checking it against
+    1..lane_value, so several highways can share one array with their lanes
+    numbered in separate blocks (see ensemble.Ensemble).
+    """
+    rear, front = arrays.leaders(arrays.lane_order())
+
+    position = arrays.position
+    lane = arrays.lane
+    new_position = position + arrays.speed
+
+    blocked = new_position[rear] >= (
+        new_position[front] - arrays.safe_distance[rear]
+    )
+    blocked_rear = rear[blocked]
+
+    # Blocked cars still advance, but try to change to a neighbouring lane.
+    # The object path walks lanes in ascending order, so the lane below has
+    # already been moved when it is inspected while the lane above has not.
+    rear_lane = lane[blocked_rear]
+    rear_position = position[blocked_rear]
+    best_lane = rear_lane.copy()
+
+    lower = rear_lane - 1
+    upper = rear_lane + 1
+    # cars left above lane_value by fewer lanes may only move back down
+    # into it, and only from the lane right above
+    offset = lane_offset[blocked_rear] if np.ndim(lane_offset) else lane_offset
+    has_lower = (lower - offset >= 1) & (lower - offset <= lane_value)
+    has_upper = upper - offset <= lane_value
+
+    # a neighbouring lane only counts if none of its cars is within the
+    # rear car's safe distance of where the rear car will be
+    target = new_position[blocked_rear]
+    low = target - arrays.safe_distance[blocked_rear]
+    high = target + arrays.safe_distance[blocked_rear]
+
+    lane_sizes = np.bincount(lane, minlength=int(upper.max(initial=0)) + 1)
+    lower_count, lower_clear = _lane_gaps(lane, new_position, lower, rear_position, low, high)
+    upper_count, upper_clear = _lane_gaps(lane, position, upper, rear_position, low, high)
+    lower_empty = lane_sizes[np.clip(lower, 0, None)] == 0
+    upper_empty = lane_sizes[upper] == 0
+    has_lower &= lower_clear
+    has_upper &= upper_clear
+
+    # prefer the lower lane unless the upper one has strictly fewer cars ahead
+    pick_upper = has_upper & (~has_lower | (~lower_empty & ~upper_empty & (upper_count < lower_count)))
+    best_lane[has_lower] = lower[has_lower]
+    best_lane[pick_upper] = upper[pick_upper]
+
+    lane[blocked_rear] = best_lane
+    arrays.happiness[blocked_rear] -= 2
+    arrays.position = new_position
+
+
+def _lane_gaps(lane, position, target_lane, rear_position, low, high):
+    """Returns (ahead, clear) for every query: the number of cars in
+    `target_lane` with a position greater than `rear_position`, and whether
+    none of them lies within low..high."""
+    ahead = np.zeros(len(target_lane), dtype=np.int64)
+    clear = np.ones(len(target_lane), dtype=np.bool_)
+    for lane_id in np.unique(target_lane):
+        in_lane = np.sort(position[lane == lane_id])
+        query = target_lane == lane_id
+        ahead[query] = len(in_lane) - np.searchsorted(
+            in_lane, rear_position[query], side="right"
+        )
+        clear[query] = np.searchsorted(in_lane, low[query], side="left") == np.searchsorted(
+            in_lane, high[query], side="right"
+        )
+    return ahead, clear
+
+
+def step_penguin(arrays, huddle_distance=1):
+    """Vectorized equivalent of HighwayTrafficSimulation.update_penguin."""
+    rear, front = arrays.leaders(arrays.lane_order())
+
+    position = arrays.position
+    speed = arrays.speed
+    new_position = position + speed
+    new_speed = speed.copy()
+
+    # rear car is in a huddle, increment the time in huddle
+    arrays.time_in_huddle[rear[arrays.is_in_huddle[rear]]] += 1
+
+    huddling = arrays.time_in_huddle[rear] >= 3
+    huddle_rear = rear[huddling]
+    huddle_front = front[huddling]
+    new_speed[huddle_rear] = np.minimum(speed[huddle_front], speed[huddle_rear])
+    new_position[huddle_rear] = (
+        position[huddle_front] + speed[huddle_front] - huddle_distance
+    )
+
+    rear = rear[~huddling]
+    front = front[~huddling]
+    blocked = position[rear] + speed[rear] >= (
+        position[front] + speed[front] - arrays.safe_distance[rear]
+    )
+    blocked_rear = rear[blocked]
+    blocked_front = front[blocked]
+    new_speed[blocked_rear] = np.minimum(speed[blocked_front], speed[blocked_rear])
+    new_position[blocked_rear] = (
+        position[blocked_front] - arrays.safe_distance[blocked_rear]
+    )
+    arrays.is_in_huddle[blocked_rear] = True
+    arrays.happiness[blocked_rear] -= 1
+
+    arrays.position = new_position
+    arrays.speed = new_speed
+
+
+def huddle_joiners(index, lane, position, safe_distance, is_in_huddle):
+    """Returns a mask of the cars that join a huddle in a neighbouring lane.
+
+    A car that is not in a huddle joins one when a huddling car drives in
+    the lane next to it, within the car's safe distance. `index` is a
+    spatial_index.CellList built over `lane` and `position`, so every car
+    only looks at the cars around it.
+    """
+    joins = np.zeros(len(lane), dtype=np.bool_)
+    candidates = np.flatnonzero(~is_in_huddle)
+    if not len(candidates) or not is_in_huddle.any():
+        return joins
+    for side in (-1, 1):
+        query, near = index.query_pairs(
+            lane[candidates] + side, position[candidates], safe_distance[candidates]
+        )
+        joins[candidates[query[is_in_huddle[near]]]] = True
+    return joins
@@ -0,0 +1,132 @@
+# In[1]: Imports
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+# Make the local app package importable when run from anywhere
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repo_dir)
+
+from app.utils.highway_traffic_and_car_sim import Car, HighwayTrafficSimulation
+from app.utils.vectorized_engine import CarArrays
+
+# In[2]: The Car as it was before slots and lookup tables, kept for comparison
+class DictCar:
+    def __init__(self, lane, position, speed, type="car", driver_type="normal", rng=random):
+        self.lane = lane
+        self.position = position
+        self.speed = speed
+        self.type = type
+        self.id = rng.randint(0, 10000000000000)
+        self.color = f"rgb({rng.randint(50,200)}, {rng.randint(50,200)}, {rng.randint(50,200)})"
+        self.driver_type = driver_type
+
+        self.time_in_huddle = 0
+        self.is_in_huddle = False
+
+        if driver_type == "normal":
+            self.safe_distance = 2
+            self.acceleration = 0.5
+            self.deceleration = 1.0
+        elif driver_type == "aggressive":
+            self.safe_distance = 1
+            self.acceleration = 1.0
+            self.deceleration = 1.5
+        elif driver_type == "cautious":
+            self.safe_distance = 3
+            self.acceleration = 0.3
+            self.deceleration = 0.8
+
+        self.ideal_speed = speed
+        self.time = 0
+        self.happiness = 10
+
+
+class DictCarSimulation(HighwayTrafficSimulation):
+    """Spawns DictCars with the old _add_car."""
+
+    def _add_car(self, spawn_probability, lane_value):
+        new_cars = []
+        for lane in range(1, lane_value + 1):
+            if self.rng.random() < (spawn_probability / 100):
+                driver_type = self.rng.choice(["normal", "aggressive", "cautious"])
+                if driver_type == "aggressive":
+                    desired_speed = self.rng.randint(5, 10)
+                elif driver_type == "normal":
+                    desired_speed = self.rng.randint(3, 8)
+                elif driver_type == "cautious":
+                    desired_speed = self.rng.randint(2, 6)
+                new_cars.append(
+                    DictCar(lane, 0, desired_speed, driver_type=driver_type, rng=self.rng)
+                )
+        self.cars.extend(new_cars)
+        self.lane_index.add(new_cars)
+
+
+# In[3]: Measurements
+def bytes_per_car(make_car, num_cars):
+    rng = random.Random(0)
+    tracemalloc.start()
+    cars = [make_car(rng) for _ in range(num_cars)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del cars
+    return size / num_cars
+
+
+def spawn_seconds_per_car(simulation_class, num_cars, lane_value=8, batch=1000):
+    """Times _add_car at a spawn rate of 100, so every lane spawns every tick."""
+    traffic_sim = simulation_class(results_dir=None, seed=0)
+    elapsed = 0.0
+    for _ in range(num_cars // batch):
+        started = time.perf_counter()
+        for _ in range(batch // lane_value):
+            traffic_sim._add_car(100, lane_value)
+        elapsed += time.perf_counter() - started
+        traffic_sim.reset()  # keep the lanes short, like on a real highway
+    return elapsed / num_cars
+
+
+def array_bytes_per_car():
+    return sum(
+        np.dtype(dtype).itemsize for dtype in CarArrays.FIELDS.values()
+    )
+
+
+def run(num_cars):
+    results = {
+        "dict": (
+            bytes_per_car(lambda rng: DictCar(1, 0, 5, rng=rng), num_cars),
+            spawn_seconds_per_car(DictCarSimulation, num_cars),
+        ),
+        "slots": (
+            bytes_per_car(lambda rng: Car(1, 0, 5, rng=rng), num_cars),
+            spawn_seconds_per_car(HighwayTrafficSimulation, num_cars),
+        ),
+    }
+
+    print(f"{'':6} {'bytes/car':>10} {'spawn us/car':>13}")
+    for name, (size, seconds) in results.items():
+        print(f"{name:6} {size:10.0f} {seconds * 1e6:13.2f}")
+    print(f"{'arrays':6} {array_bytes_per_car():10.0f}")
+
+    (dict_size, dict_seconds), (slot_size, slot_seconds) = results.values()
+    print(
+        f"slots use {dict_size / slot_size:.1f}x less memory "
+        f"and spawn {dict_seconds / slot_seconds:.1f}x faster"
+    )
+    return results
+
+
+# In[4]: Run the benchmark
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the memory and spawn cost of the slotted Car with the old dict-based one."
+    )
+    parser.add_argument("--cars", type=int, default=100_000)
+    run(parser.parse_args().cars)
@@ -0,0 +1,315 @@
+# In[1]: Imports
+import argparse
+import datetime
+import functools
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+# Make the local app package importable when run from anywhere
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(repo_dir)
+
+from app.utils.highway_traffic_and_car_sim import (
+    HIGHWAY_LENGTH,
+    HighwayTrafficSimulation,
+    _cars_from_arrays,
+)
+from app.utils.jit_kernels import NUMBA_AVAILABLE
+from app.utils.utils import create_figure, create_figure_statisticts
+from app.utils.vectorized_engine import CAR_COLORS, DRIVER_PROFILES, CarArrays
+
+CAR_COUNTS = (100, 1_000, 10_000, 100_000)
+LANE_COUNTS = (1, 2, 4, 8)
+STEPS = ("simple", "individualistic", "penguin")
+STATISTICS_ROWS = 1_000  # rows behind the statistics figure
+
+# In[2]: Fixtures
+def random_cars(num_cars, lanes, seed=0, highway_length=HIGHWAY_LENGTH):
+    """Returns CarArrays with cars spread uniformly over the highway."""
+    rng = np.random.default_rng(seed)
+    profiles = np.array(DRIVER_PROFILES, dtype=np.float64)
+
+    arrays = CarArrays()
+    arrays.driver_code = rng.integers(0, len(DRIVER_PROFILES), num_cars).astype(np.int8)
+    profile = profiles[arrays.driver_code]
+    arrays.lane = rng.integers(1, lanes + 1, num_cars)
+    arrays.position = np.sort(rng.uniform(0, highway_length, num_cars))
+    arrays.speed = rng.integers(profile[:, 3], profile[:, 4] + 1).astype(np.float64)
+    arrays.ideal_speed = arrays.speed.copy()
+    arrays.safe_distance = profile[:, 0]
+    arrays.acceleration = profile[:, 1]
+    arrays.deceleration = profile[:, 2]
+    arrays.time = np.zeros(num_cars, dtype=np.int64)
+    arrays.happiness = np.full(num_cars, 10.0)
+    arrays.time_in_huddle = np.zeros(num_cars, dtype=np.int64)
+    arrays.is_in_huddle = np.zeros(num_cars, dtype=np.bool_)
+    arrays.id = np.arange(num_cars, dtype=np.int64)
+    arrays.color_code = rng.integers(0, len(CAR_COLORS), num_cars).astype(np.uint8)
+    return arrays
+
+
+def populated_simulation(engine, arrays, statistics_rows=0, highway_length=HIGHWAY_LENGTH):
+    """Returns a simulation without statistics files holding a copy of `arrays`."""
+    traffic_sim = HighwayTrafficSimulation(
+        engine=engine, highway_length=highway_length, results_dir=None, seed=0
+    )
+    traffic_sim.next_car_id = len(arrays)
+    if engine in HighwayTrafficSimulation.ARRAY_ENGINES:
+        traffic_sim.cars = arrays.copy()
+    else:
+        traffic_sim.cars = _cars_from_arrays(arrays)
+        traffic_sim.lane_index.rebuild(traffic_sim.cars)
+
+    lanes = int(arrays.lane.max()) if len(arrays) else 1
+    for tick in range(statistics_rows):
+        traffic_sim.time_elapsed = tick
+        traffic_sim._record_statistics(
+            len(arrays), 5 + np.sin(tick / 50), len(arrays) / highway_length, [1] * lanes, 10
+        )
+    return traffic_sim
+
+
+# In[3]: Timing
+def measure(setup, run, min_time=0.2, min_repeats=3, max_repeats=50):
+    """Times `run(setup())` until `min_time` seconds have been spent in `run`.
+
+    `setup` is not timed, so every repeat can start from the same state.
+    Returns the list of run times in seconds.
+    """
+    times = []
+    while len(times) < min_repeats or (
+        sum(times) < min_time and len(times) < max_repeats
+    ):
+        state = setup()
+        started = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - started)
+    return times
+
+
+def cases(engines, car_counts, lane_counts, highway_length=HIGHWAY_LENGTH):
+    """Yields (name, params, setup, run) for every benchmark."""
+    for engine, num_cars, lanes in itertools.product(engines, car_counts, lane_counts):
+        arrays = random_cars(num_cars, lanes, highway_length=highway_length)
+        params = {
+            "engine": engine,
+            "cars": num_cars,
+            "lanes": lanes,
+            "highway_length": highway_length,
+        }
+        simulation = functools.partial(
+            populated_simulation, engine, arrays, highway_length=highway_length
+        )
+
+        for step in STEPS:
+            # no spawning, so every repeat steps exactly `num_cars` cars
+            yield (
+                f"update_{step}",
+                params,
+                simulation,
+                lambda sim, step=step, lanes=lanes: getattr(sim, f"update_{step}")(0, lanes),
+            )
+
+        yield (
+            "_calculate_statistics",
+            params,
+            simulation,
+            lambda sim, lanes=lanes: sim._calculate_statistics(lanes),
+        )
+
+        for spawning in HighwayTrafficSimulation.SPAWNING:
+            # every lane spawns, 100 ticks worth of new cars
+            yield (
+                f"_add_car_{spawning}",
+                params,
+                lambda engine=engine, spawning=spawning: HighwayTrafficSimulation(
+                    engine=engine, results_dir=None, seed=0, spawning=spawning
+                ),
+                lambda sim, lanes=lanes: [sim._add_car(100, lanes) for _ in range(100)],
+            )
+
+        sim = simulation(STATISTICS_ROWS)
+        yield (
+            "create_figure",
+            params,
+            lambda sim=sim: sim,
+            lambda sim, lanes=lanes: create_figure(lanes, sim),
+        )
+        yield (
+            "create_figure_statisticts",
+            params,
+            lambda sim=sim: sim,
+            create_figure_statisticts,
+        )
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=repo_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "numba": NUMBA_AVAILABLE,
+        "machine": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+    }
+
+
+def run_suite(
+    engines,
+    car_counts,
+    lane_counts,
+    select=None,
+    min_time=0.2,
+    highway_length=HIGHWAY_LENGTH,
+):
+    results = []
+    for name, params, setup, run in cases(engines, car_counts, lane_counts, highway_length):
+        if select and not any(pattern in name for pattern in select):
+            continue
+        times = measure(setup, run, min_time=min_time)
+        median = statistics.median(times)
+        results.append(
+            {
+                "name": name,
+                **params,
+                "median_s": median,
+                "min_s": min(times),
+                "repeats": len(times),
+                "per_second": 1 / median if median > 0 else None,
+            }
+        )
+        print(
+            f"{name:26} {params['engine']:10} {params['cars']:>7} cars "
+            f"{params['lanes']} lanes  {median * 1e3:10.3f} ms"
+        )
+    return {"environment": environment(), "results": results}
+
+
+# In[4]: Comparing runs
+def _key(result):
+    return (
+        result["name"],
+        result["engine"],
+        result["cars"],
+        result["lanes"],
+        result.get("highway_length", HIGHWAY_LENGTH),
+    )
+
+
+def compare(baseline, current, threshold=1.2):
+    """Prints how every benchmark changed and returns the regressions.
+
+    A benchmark regressed when its median grew by more than `threshold`.
+    """
+    before = {_key(result): result for result in baseline["results"]}
+    regressions = []
+    print(
+        f"\nCompared with {baseline['environment'].get('commit')} "
+        f"({baseline['environment'].get('date')}):"
+    )
+    for result in current["results"]:
+        old = before.get(_key(result))
+        if old is None:
+            continue
+        ratio = result["median_s"] / old["median_s"]
+        flag = ""
+        if ratio > threshold:
+            flag = "  SLOWER"
+            regressions.append((result, ratio))
+        elif ratio < 1 / threshold:
+            flag = "  faster"
+        name, engine, cars, lanes, _ = _key(result)
+        print(f"{name:26} {engine:10} {cars:>7} cars {lanes} lanes  {ratio:6.2f}x{flag}")
+    return regressions
+
+
+# In[5]: Command line interface
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Time simulation steps, statistics and figures and store the results as JSON."
+    )
+    parser.add_argument(
+        "--engines",
+        nargs="+",
+        default=list(HighwayTrafficSimulation.ENGINES),
+        choices=HighwayTrafficSimulation.ENGINES,
+    )
+    parser.add_argument("--cars", nargs="+", type=int, default=list(CAR_COUNTS))
+    parser.add_argument("--lanes", nargs="+", type=int, default=list(LANE_COUNTS))
+    parser.add_argument("--highway-length", type=float, default=HIGHWAY_LENGTH)
+    parser.add_argument(
+        "--select",
+        nargs="+",
+        help="only run benchmarks whose name contains one of these strings",
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="seconds to spend timing each benchmark, at least three repeats",
+    )
+    parser.add_argument(
+        "--output",
+        help="JSON file for the results, by default benchmarks/results/<commit>.json",
+    )
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=1.2,
+        help="slowdown factor reported as a regression",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    suite = run_suite(
+        args.engines,
+        args.cars,
+        args.lanes,
+        args.select,
+        args.min_time,
+        args.highway_length,
+    )
+
+    output = args.output or os.path.join(
+        repo_dir,
+        "benchmarks",
+        "results",
+        f"{suite['environment']['commit'] or 'results'}.json",
+    )
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(suite, f, indent=1)
+    print(f"Wrote {len(suite['results'])} results to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), suite, args.threshold)
+        if regressions:
+            sys.exit(1)
+
+
+# In[6]: Run the suite
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+# In[1]: Imports
+import os
+import sys
+
+# Make the local app package importable when run from anywhere
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(current_dir)
+
+from app.utils.batch import main
+
+# In[2]: Run the batch
+if __name__ == "__main__":
+    main()
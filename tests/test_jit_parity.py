@@ -0,0 +1,50 @@
+"""Parity of the compiled and plain Python kernels and of the three engines."""
+import numpy as np
+import pytest
+
+from app.utils.highway_traffic_and_car_sim import HighwayTrafficSimulation
+from app.utils.jit_kernels import check_parity
+from app.utils.vectorized_engine import CarArrays
+
+CAR_STATE = (
+    "id",
+    "lane",
+    "position",
+    "speed",
+    "happiness",
+    "time",
+    "time_in_huddle",
+    "is_in_huddle",
+)
+
+
+def _car_state(sim):
+    cars = sim.cars if sim.engine in sim.ARRAY_ENGINES else CarArrays.from_cars(sim.cars)
+    order = np.argsort(cars.id)
+    return {name: getattr(cars, name)[order] for name in CAR_STATE}
+
+
+def test_compiled_kernels_match_python():
+    assert check_parity(num_cars=500, steps=50)
+
+
+@pytest.mark.parametrize("spawning", [None, *HighwayTrafficSimulation.SPAWNING])
+@pytest.mark.parametrize("simulation_type", HighwayTrafficSimulation.SIMULATION_TYPES)
+def test_engines_match(simulation_type, spawning):
+    sims = [
+        HighwayTrafficSimulation(engine=engine, results_dir=None, seed=7, spawning=spawning)
+        for engine in HighwayTrafficSimulation.ENGINES
+    ]
+    for tick in range(120):
+        # fewer lanes halfway through, the cars above keep driving
+        lane_value = 4 if tick < 60 else 2
+        for sim in sims:
+            sim.update(simulation_type, 60, lane_value)
+
+        expected = _car_state(sims[0])
+        for sim in sims[1:]:
+            state = _car_state(sim)
+            for name in CAR_STATE:
+                np.testing.assert_array_equal(
+                    state[name], expected[name], err_msg=f"{sim.engine} {name} at tick {tick}"
+                )